@@ -1,43 +1,131 @@
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
 from langchain_core.runnables import RunnableSerializable
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.rate_limiters import BaseRateLimiter
+import asyncio
 import json
-from setup import llm, prompt
-from tools.tool import tools, tool_func_map
-from memory.message_history import JSONMessageHistory
+import threading
+from setup import get_llm, get_prompt
+from tools.tool import tools, run_tool
+from memory.base_history import MessageHistory
+from memory.history_window import HistoryWindow
+from agent.question_cache import QuestionCache, turn_key
+from db.context import QueryContext
+from db.query_runner import query_runner
+from db.schema_index import prune_schema
+from handlers.queue_callback_handler import QueueCallbackHandler
+from monitoring.metrics import agent_iterations, cache_requests, speculation_rounds
+from monitoring.tracing import tracer, Trace
 
 class CustomAgentExecutor:
-    def __init__(self, message_history: JSONMessageHistory):
+    def __init__(
+        self,
+        message_history: MessageHistory,
+        history_window: HistoryWindow | None = None,
+        question_cache: QuestionCache | None = None,
+        fast_final_answer: bool = True,
+        llm: BaseChatModel | None = None,
+        speculative_candidates: int = 1,
+        rate_limiter: BaseRateLimiter | None = None,
+    ):
         self.message_history = message_history
-        self.chat_history: list[BaseMessage] = []
+        # keeps the chat history part of the prompt within a token budget
+        self.history_window = history_window or HistoryWindow()
+        # SQL that answered earlier questions, repeated questions skip the llm when set
+        self.question_cache = question_cache
+        # end the loop as soon as a query succeeds and build the answer locally,
+        # set to False to let the llm summarize the result with the final_answer tool
+        self.fast_final_answer = fast_final_answer
         self.max_iterations: int = 5
-        self.agent: RunnableSerializable = (
+        # any chat model with tool calling works, e.g. a local stub in tests.
+        # Without one the shared Gemini model is used, it and the agents are only built on first use,
+        # so creating an executor stays cheap and does not need credentials
+        self._llm = llm
+        # limits the llm requests of this executor only, e.g. to keep batches from using up the quota
+        self.rate_limiter = rate_limiter
+        self._candidate_agents: list[RunnableSerializable] | None = None
+        self._build_lock = threading.Lock()
+
+        # opt-in speculation, ainvoke asks several candidates for SQL at once and keeps the first
+        # that executes successfully. Candidates beyond the first use a higher temperature,
+        # so they tend to write different queries
+        # How often it saved a round is counted in monitoring.metrics.speculation_rounds
+        self.speculative_candidates = speculative_candidates
+
+    @property
+    def candidate_agents(self) -> list[RunnableSerializable]:
+        """ The agents asked for SQL in each round, the first one is self.agent. Built on first use """
+        if self._candidate_agents is None:
+            with self._build_lock:
+                if self._candidate_agents is None:
+                    llm = self._llm or get_llm()
+                    if self.rate_limiter is not None:
+                        llm = llm.model_copy(update={"rate_limiter": self.rate_limiter})
+                    self._candidate_agents = [self._build_agent(llm)] + [
+                        self._build_agent(llm.model_copy(update={"temperature": min(1.0, 0.3 * i)}))
+                        for i in range(1, self.speculative_candidates)
+                    ]
+        return self._candidate_agents
+
+    @property
+    def agent(self) -> RunnableSerializable:
+        return self.candidate_agents[0]
+
+    @staticmethod
+    def _build_agent(llm: BaseChatModel) -> RunnableSerializable:
+        return (
             {
                 "database_schema": lambda x: x["database_schema"],
                 "input": lambda x: x["input"],
                 "chat_history": lambda x: x["chat_history"],
                 "agent_scratchpad": lambda x: x["agent_scratchpad"]
             }
-            | prompt
+            | get_prompt()
             | llm.bind_tools(tools, tool_choice="any")
         )
 
-    def invoke(self, database_schema: str, input: str, chat_id: str):
+    def invoke(self, context: QueryContext, input: str):
         # keep invoking the agent iteratively in a loop until we get the final answer
+        # all per request state lives in the context, the executor is shared across requests
         count = 0
+        chat_id = context.chat_id
+        # None unless this question is sampled for the local trace log
+        trace = tracer.start(chat_id, input)
+
+        # chat history does not change while the loop runs, so read and window it once per run
+        with context.timed("history"):
+            chat_history = self.history_window.select(chat_id, self.message_history.load(chat_id))
+
+        # a repeated question against the same schema reuses the SQL that answered it last time.
+        # A follow up like "sort them" depends on the chat, the previous turn is part of the key
+        previous_turn = self._previous_turn(chat_history)
+        with context.timed("question_cache"):
+            final_answer = self._cached_answer(context, input, previous_turn)
+        if final_answer is not None:
+            agent_iterations.observe(0)
+            with context.timed("history"):
+                self.message_history.save(chat_id, self._new_turn(input, final_answer, context))
+            self._trace_finish(trace, context, final_answer, count, cached=True)
+            return final_answer
+
+        # large databases only get the tables relevant to the question in the prompt
+        with context.timed("schema_prune"):
+            database_schema, pruned = prune_schema(context.schema_index, context.table_schema_info, input)
 
         # this is temporary storage for each agent execution loop, so we only define it here
         agent_scratchpad = []
-        found_final_answer = False
+        final_answer = None
         while count < self.max_iterations:
             # invoke one iteration of the agent
-            tool_call = self.agent.invoke(
-                {
-                    "database_schema": database_schema,
-                    "input": input,
-                    "chat_history": self.message_history.load(chat_id),
-                    "agent_scratchpad": agent_scratchpad
-                }
-            )
+            with context.timed("llm"):
+                tool_call = self.agent.invoke(
+                    {
+                        "database_schema": database_schema,
+                        "input": input,
+                        "chat_history": chat_history,
+                        "agent_scratchpad": agent_scratchpad
+                    }
+                )
 
             # add initial tool call to the scratchpad
             agent_scratchpad.append(tool_call)
@@ -47,24 +135,323 @@ class CustomAgentExecutor:
             tool_args = tool_call.tool_calls[0]["args"]
 
             # now execute the tool and add output to the scratchpad
-            tool_execution_content = tool_func_map[tool_name](**tool_args)
+            with context.timed("tool"):
+                tool_execution_content = run_tool(tool_name, tool_args, context)
+            agent_scratchpad.append(self._tool_message(tool_call, tool_execution_content))
+            count += 1
+            self._trace_step(trace, count, database_schema, chat_history, agent_scratchpad, tool_call, context)
 
-            tool_exec = ToolMessage(
-                content=f"The {tool_name} tool returned {tool_execution_content}",
-                tool_call_id = tool_call.tool_calls[0]["id"]
-            )
-            agent_scratchpad.append(tool_exec)
+            # the pruned schema may be missing a table the query needs, retry with the full schema
+            if pruned and context.query_failed:
+                database_schema, pruned = context.table_schema_info, False
 
             # check if the current tool is the final answer tool
             if tool_name == "final_answer":
-                found_final_answer = True
+                final_answer = tool_args
                 break
-        
-        final_answer = tool_args if found_final_answer else {"answer":"No answer found", "tools_used":[]}
-        self.chat_history.extend([
-            HumanMessage(content=input),
-            AIMessage(content=json.dumps(final_answer))
-        ])
-        self.message_history.save(chat_id, self.chat_history)
+
+            # a successful query already answers the question, skip the llm round trip
+            # that would only summarize it
+            if self.fast_final_answer and tool_name == "execute_query" and not context.query_failed:
+                final_answer = self._local_answer(context)
+                break
+
+        agent_iterations.observe(count)
+        with context.timed("question_cache"):
+            self._remember_sql(context, input, previous_turn, final_answer is not None)
+        if final_answer is None:
+            final_answer = {"answer":"No answer found", "tools_used":[]}
+        with context.timed("history"):
+            self.message_history.save(chat_id, self._new_turn(input, final_answer, context))
+        self._trace_finish(trace, context, final_answer, count)
         return final_answer
-            
\ No newline at end of file
+
+    async def ainvoke(
+        self,
+        context: QueryContext,
+        input: str,
+        streamer: QueueCallbackHandler | None = None,
+        use_history: bool = True,
+    ):
+        # same loop as invoke, but llm calls use the async api and blocking work
+        # (sql execution, history files) runs in worker threads, so the event loop stays free.
+        # With a streamer, llm tokens and step events are pushed to it as they happen.
+        # Without use_history the question is answered on its own and not added to the chat history
+        count = 0
+        chat_id = context.chat_id
+        trace = tracer.start(chat_id, input)
+
+        chat_history = []
+        if use_history:
+            with context.timed("history"):
+                chat_history = await asyncio.to_thread(self.message_history.load, chat_id)
+                chat_history = self.history_window.select(chat_id, chat_history)
+
+        previous_turn = self._previous_turn(chat_history)
+        with context.timed("question_cache"):
+            final_answer = await self._acached_answer(context, input, previous_turn)
+        if final_answer is not None:
+            agent_iterations.observe(0)
+            await self._emit(streamer, "sql_generated", {"sql": context.result_query, "cached": True})
+            await self._emit_result(streamer, context)
+            await self._emit(streamer, "final_answer", final_answer)
+            if use_history:
+                with context.timed("history"):
+                    await asyncio.to_thread(self.message_history.save, chat_id, self._new_turn(input, final_answer, context))
+            self._trace_finish(trace, context, final_answer, count, cached=True)
+            return final_answer
+        with context.timed("schema_prune"):
+            database_schema, pruned = prune_schema(context.schema_index, context.table_schema_info, input)
+
+        agent_scratchpad = []
+        final_answer = None
+        while count < self.max_iterations:
+            agent_input = {
+                "database_schema": database_schema,
+                "input": input,
+                "chat_history": chat_history,
+                "agent_scratchpad": agent_scratchpad
+            }
+            if self.speculative_candidates > 1:
+                # llm calls and queries of the candidates overlap, so they are timed together
+                with context.timed("speculation"):
+                    tool_call, tool_execution_content = await self._speculate(agent_input, context)
+                tool_name = tool_call.tool_calls[0]["name"]
+                tool_args = tool_call.tool_calls[0]["args"]
+                if tool_name == "execute_query":
+                    await self._emit(streamer, "sql_generated", {"sql": tool_args["sql_query"]})
+            else:
+                with context.timed("llm"):
+                    tool_call = await self._acall_agent(agent_input, streamer)
+                tool_name = tool_call.tool_calls[0]["name"]
+                tool_args = tool_call.tool_calls[0]["args"]
+                if tool_name == "execute_query":
+                    await self._emit(streamer, "sql_generated", {"sql": tool_args["sql_query"]})
+                    await self._emit(streamer, "executing", {"sql": tool_args["sql_query"]})
+                with context.timed("tool"):
+                    tool_execution_content = await self._arun_tool(tool_name, tool_args, context)
+            agent_scratchpad.append(tool_call)
+            agent_scratchpad.append(self._tool_message(tool_call, tool_execution_content))
+            count += 1
+            self._trace_step(trace, count, database_schema, chat_history, agent_scratchpad, tool_call, context)
+
+            if tool_name == "execute_query":
+                if context.query_failed:
+                    await self._emit(streamer, "query_error", {"error": tool_execution_content})
+                else:
+                    await self._emit_result(streamer, context)
+
+            if pruned and context.query_failed:
+                database_schema, pruned = context.table_schema_info, False
+
+            if tool_name == "final_answer":
+                final_answer = tool_args
+                break
+
+            if self.fast_final_answer and tool_name == "execute_query" and not context.query_failed:
+                final_answer = self._local_answer(context)
+                break
+
+        agent_iterations.observe(count)
+        with context.timed("question_cache"):
+            await asyncio.to_thread(self._remember_sql, context, input, previous_turn, final_answer is not None)
+        if final_answer is None:
+            final_answer = {"answer":"No answer found", "tools_used":[]}
+        await self._emit(streamer, "final_answer", final_answer)
+        if use_history:
+            with context.timed("history"):
+                await asyncio.to_thread(self.message_history.save, chat_id, self._new_turn(input, final_answer, context))
+        self._trace_finish(trace, context, final_answer, count)
+        return final_answer
+
+    async def _acall_agent(self, agent_input: dict, streamer: QueueCallbackHandler | None) -> AIMessage:
+        if streamer is None:
+            return await self.agent.ainvoke(agent_input)
+
+        # stream the llm response so its tokens reach the streamer as they are generated,
+        # then merge the chunks into a single message, no more than one tool is called at once
+        output = None
+        async for chunk in self.agent.astream(agent_input, config={"callbacks": [streamer]}):
+            output = chunk if output is None else output + chunk
+        return AIMessage(content=output.content, tool_calls=output.tool_calls)
+
+    @staticmethod
+    async def _emit(streamer: QueueCallbackHandler | None, event: str, data: dict):
+        if streamer is not None:
+            await streamer.emit(event, data)
+
+    @classmethod
+    async def _emit_result(cls, streamer: QueueCallbackHandler | None, context: QueryContext):
+        # the rows kept by execute_query, more are available through result handles
+        if streamer is None or context.result_df is None:
+            return
+        await cls._emit(streamer, "rows", {
+            "query": context.result_query,
+            "num_rows": context.result_num_rows,
+            "columns": context.result_df.columns.tolist(),
+            "rows": context.result_df.values.tolist(),
+        })
+
+    async def _speculate(self, agent_input: dict, context: QueryContext) -> tuple[AIMessage, str]:
+        """
+        Run one agent round with several candidates at once. Each candidate asks the llm
+        for a tool call and runs it in its own read only fork of the context.
+        The first candidate whose query succeeds wins and the others are cancelled,
+        if none succeeds the first candidate's outcome is used, like a sequential round.
+        Returns the winning tool call and its tool output, the winner's results are adopted into context
+        """
+        async def run_candidate(index: int, agent: RunnableSerializable):
+            tool_call = await agent.ainvoke(agent_input)
+            candidate_context = context.fork()
+            tool_execution_content = await self._arun_tool(
+                tool_call.tool_calls[0]["name"], tool_call.tool_calls[0]["args"], candidate_context
+            )
+            return index, (tool_call, tool_execution_content, candidate_context)
+
+        tasks = [asyncio.create_task(run_candidate(i, agent)) for i, agent in enumerate(self.candidate_agents)]
+        outcomes = {}
+        winner = None
+        try:
+            for done in asyncio.as_completed(tasks):
+                try:
+                    index, outcome = await done
+                except Exception:
+                    # one failing candidate must not fail the round, the first candidate is checked below
+                    continue
+                outcomes[index] = outcome
+                tool_call, _, candidate_context = outcome
+                if tool_call.tool_calls[0]["name"] == "execute_query" and not candidate_context.query_failed:
+                    winner = index
+                    break
+        finally:
+            # cancels outstanding llm calls, a query already running in a worker thread finishes on its own
+            for task in tasks:
+                task.cancel()
+
+        if winner is None:
+            # nothing succeeded, fall back to what a sequential round would have done
+            speculation_rounds.inc(outcome="fallback")
+            if 0 not in outcomes:
+                # the first candidate raised, surface its error like a sequential round would
+                await tasks[0]
+            winner = 0
+        elif winner == 0:
+            speculation_rounds.inc(outcome="first")
+        else:
+            first_failed = 0 in outcomes
+            speculation_rounds.inc(outcome="saved_round" if first_failed else "early_win")
+
+        tool_call, tool_execution_content, candidate_context = outcomes[winner]
+        context.adopt(candidate_context)
+        return tool_call, tool_execution_content
+
+    async def _arun_tool(self, tool_name: str, tool_args: dict, context: QueryContext):
+        # final_answer only echoes its arguments, everything else touches the database
+        if tool_name == "final_answer":
+            return run_tool(tool_name, tool_args, context)
+        return await query_runner.run(context.db_path, run_tool, tool_name, tool_args, context)
+
+    def _cached_answer(self, context: QueryContext, input: str, previous_turn: str) -> dict | None:
+        if self.question_cache is None:
+            return None
+        sql_query = self.question_cache.get(input, context.schema_fingerprint, previous_turn)
+        cache_requests.inc(cache="question", outcome="hit" if sql_query is not None else "miss")
+        if sql_query is None:
+            return None
+        run_tool("execute_query", {"sql_query": sql_query}, context)
+        return self._answer_from_cache(context, input, previous_turn)
+
+    async def _acached_answer(self, context: QueryContext, input: str, previous_turn: str) -> dict | None:
+        if self.question_cache is None:
+            return None
+        sql_query = await asyncio.to_thread(self.question_cache.get, input, context.schema_fingerprint, previous_turn)
+        cache_requests.inc(cache="question", outcome="hit" if sql_query is not None else "miss")
+        if sql_query is None:
+            return None
+        await self._arun_tool("execute_query", {"sql_query": sql_query}, context)
+        return self._answer_from_cache(context, input, previous_turn)
+
+    def _answer_from_cache(self, context: QueryContext, input: str, previous_turn: str) -> dict | None:
+        if context.query_failed:
+            # the cached SQL does not work anymore, forget it and let the llm write a new one
+            self.question_cache.invalidate(input, context.schema_fingerprint, previous_turn)
+            return None
+        return self._local_answer(context)
+
+    def _remember_sql(self, context: QueryContext, input: str, previous_turn: str, found_final_answer: bool):
+        # only cache SQL that ran successfully and led to a final answer
+        if self.question_cache is not None and found_final_answer and context.result_query and not context.query_failed:
+            self.question_cache.put(input, context.schema_fingerprint, context.result_query, previous_turn)
+
+    @staticmethod
+    def _previous_turn(chat_history: list[BaseMessage]) -> str:
+        # the question and SQL of the last turn the llm sees, empty without history.
+        # Turns saved without SQL (no answer, or older chats) use the answer text instead
+        for i in range(len(chat_history) - 1, 0, -1):
+            message, question = chat_history[i], chat_history[i - 1]
+            if isinstance(message, AIMessage) and isinstance(question, HumanMessage):
+                return turn_key(str(question.content), message.additional_kwargs.get("sql") or str(message.content))
+        # only a summary of earlier questions is left in the window
+        return "\n".join(str(message.content) for message in chat_history)
+
+    @staticmethod
+    def _trace_step(
+        trace: Trace | None,
+        iteration: int,
+        database_schema: str,
+        chat_history: list[BaseMessage],
+        agent_scratchpad: list[BaseMessage],
+        tool_call: AIMessage,
+        context: QueryContext,
+    ):
+        if trace is None:
+            return
+        # size of the prompt the llm saw for this step, the scratchpad ends with this step's call and result
+        prompt_chars = len(database_schema) + sum(
+            len(str(message.content)) for message in chat_history + agent_scratchpad[:-2]
+        )
+        step = tool_call.tool_calls[0]
+        data = {"iteration": iteration, "prompt_chars": prompt_chars, "tool": step["name"], "args": dict(step["args"])}
+        if step["name"] == "execute_query":
+            # the executed sql differs from the llm's when identifiers were repaired
+            data["failed"] = context.query_failed
+            if not context.query_failed:
+                data.update(sql=context.result_query, num_rows=context.result_num_rows)
+        trace.record("step", **data)
+
+    @staticmethod
+    def _trace_finish(trace: Trace | None, context: QueryContext, final_answer: dict, iterations: int, cached: bool = False):
+        if trace is not None:
+            trace.record(
+                "finish", answer=final_answer.get("answer"), iterations=iterations, cached=cached,
+                sql=context.result_query, timings=dict(context.timings),
+            )
+
+    @staticmethod
+    def _local_answer(context: QueryContext) -> dict:
+        # same shape and style as the answers of the final_answer tool, built from the query result
+        columns = context.result_df.columns.tolist() if context.result_df is not None else []
+        answer = f"Successfully executed the query, returned {context.result_num_rows} rows"
+        if columns:
+            shown = ", ".join(str(column) for column in columns[:8])
+            more = f" and {len(columns) - 8} more" if len(columns) > 8 else ""
+            answer += f" with columns {shown}{more}"
+        return {"answer": answer, "tools_used": ["execute_query"]}
+
+    @staticmethod
+    def _tool_message(tool_call: AIMessage, tool_execution_content) -> ToolMessage:
+        tool_name = tool_call.tool_calls[0]["name"]
+        return ToolMessage(
+            content=f"The {tool_name} tool returned {tool_execution_content}",
+            tool_call_id = tool_call.tool_calls[0]["id"]
+        )
+
+    @staticmethod
+    def _new_turn(input: str, final_answer: dict, context: QueryContext) -> list[BaseMessage]:
+        # only the new Human + AI message pair is saved, the history backend appends it.
+        # The SQL behind the answer is kept with it, it keys the question cache for the next question
+        sql = context.result_query if context.result_query and not context.query_failed else None
+        return [
+            HumanMessage(content=input),
+            AIMessage(content=json.dumps(final_answer), additional_kwargs={"sql": sql} if sql else {})
+        ]
@@ -0,0 +1,36 @@
+import asyncio
+from typing import AsyncIterator
+from agent.agent_executor import CustomAgentExecutor
+from db.context import QueryContext
+
+async def answer_batch(
+    executor: CustomAgentExecutor,
+    context: QueryContext,
+    prompts: list[str],
+    parallelism: int = 4,
+) -> AsyncIterator[tuple[int, QueryContext, dict | None, Exception | None]]:
+    """
+    Answer many questions against one database concurrently, at most parallelism at a time.
+    Every question runs in its own fork of the context, so they share the loaded schema and engine
+    but not their results, and none of them reads or writes the chat history.
+    Yields (index, context, answer, error) for each question as soon as it is done.
+    Stopping the iteration cancels the questions still running
+    """
+    limit = asyncio.Semaphore(parallelism)
+
+    async def answer(index: int, prompt: str):
+        question_context = context.fork()
+        async with limit:
+            try:
+                output = await executor.ainvoke(question_context, prompt, use_history=False)
+            except Exception as e:
+                return index, question_context, None, e
+        return index, question_context, output, None
+
+    tasks = [asyncio.create_task(answer(i, prompt)) for i, prompt in enumerate(prompts)]
+    try:
+        for done in asyncio.as_completed(tasks):
+            yield await done
+    finally:
+        for task in tasks:
+            task.cancel()
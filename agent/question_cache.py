@@ -0,0 +1,173 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# sentence punctuation at the end of a question, ascii and full width
+TRAILING_PUNCTUATION = re.compile(r"[\s.?!,;:。？！，；：]+$")
+
+def normalize_question(question: str) -> str:
+    """
+    Lowercase a question, collapse whitespace and drop trailing punctuation.
+    Everything else is kept, operators like < and > and non latin text change the meaning
+    """
+    return TRAILING_PUNCTUATION.sub("", " ".join(question.casefold().split()))
+
+
+def turn_key(question: str, sql: str) -> str:
+    """
+    Part of the cache key of a follow up question: the question and the SQL of the turn before it.
+    A follow up like "sort them" only reuses SQL written after the same earlier turn
+    """
+    return f"{normalize_question(question)}\n{sql}"
+
+
+class QuestionCache:
+    """
+    Cache of the SQL query that answered a natural language question.
+    Keyed on the normalized question, a fingerprint of the database schema and the previous turn
+    of the chat (see turn_key, empty for a first question), so a repeated question against the same
+    schema after the same turn can run its SQL without calling the llm.
+    Entries live in an in memory LRU tier and in a sqlite file that survives restarts,
+    both expire after ttl_seconds
+    """
+    def __init__(
+        self,
+        path: str | None = None,
+        max_entries: int = 1024,
+        ttl_seconds: float = 7 * 24 * 3600,
+        max_disk_entries: int = 100_000,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+        # key -> (sql, time stored)
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS question_cache ("
+                    "key TEXT PRIMARY KEY, sql TEXT NOT NULL, stored_at REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS question_cache_stored_at ON question_cache (stored_at)")
+            # drop what expired while the server was down
+            self._prune()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(question: str, schema_fingerprint: str, previous_turn: str = "") -> str:
+        normalized = normalize_question(question)
+        # first questions keep the key they had before follow ups were cached, a normalized
+        # question has no newlines so the two forms cannot collide
+        if not previous_turn:
+            return hashlib.sha256(f"{schema_fingerprint}\n{normalized}".encode()).hexdigest()
+        return hashlib.sha256(f"{schema_fingerprint}\n{previous_turn}\n{normalized}".encode()).hexdigest()
+
+    def get(self, question: str, schema_fingerprint: str, previous_turn: str = "") -> str | None:
+        """
+        Return the cached SQL for a question against a schema after a previous turn, or None on a miss
+        """
+        key = self.key(question, schema_fingerprint, previous_turn)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        if self.path:
+            row = self._connection().execute(
+                "SELECT sql, stored_at FROM question_cache WHERE key = ? AND stored_at >= ?",
+                (key, now - self.ttl_seconds),
+            ).fetchone()
+            if row is not None:
+                with self._lock:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                return row[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, question: str, schema_fingerprint: str, sql: str, previous_turn: str = ""):
+        """ Store the SQL that answered a question against a schema after a previous turn """
+        key = self.key(question, schema_fingerprint, previous_turn)
+        now = time.time()
+        with self._lock:
+            self._remember(key, sql, now)
+
+        if self.path:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO question_cache (key, sql, stored_at) VALUES (?, ?, ?)",
+                    (key, sql, now),
+                )
+
+            # keep the file bounded, pruning on every put would cost more than the insert
+            with self._lock:
+                self._puts += 1
+                prune = self._puts % 256 == 0
+            if prune:
+                self._prune()
+
+    def invalidate(self, question: str, schema_fingerprint: str, previous_turn: str = ""):
+        """ Forget the SQL of a question, used when the cached SQL stops working """
+        key = self.key(question, schema_fingerprint, previous_turn)
+        with self._lock:
+            self._entries.pop(key, None)
+
+        if self.path:
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM question_cache WHERE key = ?", (key,))
+
+    def stats(self) -> dict[str, int]:
+        """ Hit and miss counters and the number of entries held in memory """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def _prune(self):
+        # delete expired rows and everything beyond the newest max_disk_entries
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM question_cache WHERE stored_at < ?", (time.time() - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM question_cache WHERE key NOT IN "
+                "(SELECT key FROM question_cache ORDER BY stored_at DESC LIMIT ?)",
+                (self.max_disk_entries,),
+            )
+
+    def _remember(self, key: str, sql: str, stored_at: float):
+        # caller holds the lock
+        self._entries[key] = (sql, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
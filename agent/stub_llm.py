@@ -0,0 +1,72 @@
+import time
+import asyncio
+import json
+import itertools
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# unique tool call ids across all stub instances
+_tool_call_ids = itertools.count()
+
+class StubChatModel(BaseChatModel):
+    """
+    Deterministic local chat model that replays scripted tool calls, for tests and benchmarks.
+    Each entry of script is the tool call for one agent iteration, either a dict like
+    {"name": "execute_query", "args": {"sql_query": "..."}} or a function
+    (messages, temperature) -> dict, so copies with a different temperature can answer differently.
+    A step may also set "latency" to take longer or shorter than the model's latency.
+    The iteration is the number of tool results already in the prompt, the last entry repeats
+    """
+    script: list[Any]
+    temperature: float = 0.0
+    # seconds to wait before answering, to mimic network and generation time
+    latency: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def bind_tools(self, tools, **kwargs):
+        # the script decides which tool is called, the tool schemas are not needed
+        return self
+
+    def _next_message(self, messages: list[BaseMessage]) -> tuple[AIMessage, float]:
+        # returns the scripted message and how long to take for it
+        self.calls += 1
+        iteration = sum(isinstance(message, ToolMessage) for message in messages)
+        step = self.script[min(iteration, len(self.script) - 1)]
+        if callable(step):
+            step = step(messages, self.temperature)
+        tool_call = {"name": step["name"], "args": step["args"], "id": f"stub-{next(_tool_call_ids)}"}
+        return AIMessage(content="", tool_calls=[tool_call]), step.get("latency", self.latency)
+
+    def _generate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        message, latency = self._next_message(messages)
+        if latency:
+            time.sleep(latency)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        message, latency = self._next_message(messages)
+        if latency:
+            await asyncio.sleep(latency)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs):
+        # the tool call arguments arrive in a few pieces, like a streaming provider sends them
+        message, latency = self._next_message(messages)
+        tool_call = message.tool_calls[0]
+        args = json.dumps(tool_call["args"])
+        pieces = [args[i:i + 16] for i in range(0, len(args), 16)]
+        for i, piece in enumerate(pieces):
+            if latency:
+                await asyncio.sleep(latency / len(pieces))
+            tool_call_chunk = {"name": tool_call["name"] if i == 0 else None, "args": piece,
+                               "id": tool_call["id"] if i == 0 else None, "index": 0}
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[tool_call_chunk]))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
@@ -1,22 +1,26 @@
 import streamlit as st
 import requests
+from requests_toolbelt.multipart.encoder import MultipartEncoder
 import uuid
 import os
 import pandas as pd
 
-from memory.message_history import JSONMessageHistory
+from memory.sqlite_history import SQLiteMessageHistory
 from langchain_core.messages import HumanMessage, AIMessage
 
 # --------------------------- INITIAL SETUP ---------------------------
 st.set_page_config(page_title="NL-to-SQL Agent", layout="wide")
 
 if "bootstrapped" not in st.session_state:
-    st.session_state["json_history"] = JSONMessageHistory(root_path="data")
+    st.session_state["history"] = SQLiteMessageHistory(root_path="data")
     st.session_state["sessions"] = {}
     st.session_state["current_session"] = None
     st.session_state["bootstrapped"] = True
 
-history_manager = st.session_state["json_history"]
+history_manager = st.session_state["history"]
+
+# rows per page when browsing a full query result
+PAGE_ROWS = 50
 
 # --------------------------- SIDEBAR ---------------------------
 st.sidebar.title("💬 Chats")
@@ -43,6 +47,7 @@ if not st.session_state["current_session"]:
     st.stop()
 
 chat_id = st.session_state["current_session"]
+# the frontend keeps its own history (with query + result metadata) apart from the agent's history
 chat_file = f"{chat_id}.json"
 db_file_path = f"data/db/{chat_id}.db"
 
@@ -58,13 +63,36 @@ uploaded_file = st.sidebar.file_uploader(
     key=f"uploader_{chat_id}",
 )
 
-if uploaded_file is not None:
-    os.makedirs("data/db", exist_ok=True)
-    with open(db_file_path, "wb") as f:
-        f.write(uploaded_file.read())
-    st.session_state["sessions"][chat_id]["db_path"] = db_file_path
-    st.sidebar.success("✅ Database uploaded successfully!")
-elif st.session_state["sessions"][chat_id]["db_path"]:
+session_meta = st.session_state["sessions"][chat_id]
+
+# Streamlit reruns this script on every interaction, only send each uploaded file once
+if uploaded_file is not None and session_meta.get("upload_id") != uploaded_file.file_id:
+    # The backend stores the db for this chat and caches its schema right away
+    try:
+        # stream the file object in the multipart body instead of building the whole body in memory
+        uploaded_file.seek(0)
+        encoder = MultipartEncoder(fields={
+            "uuid": chat_id,
+            "file": (uploaded_file.name, uploaded_file, "application/octet-stream"),
+        })
+        response = requests.post(
+            "http://localhost:8000/upload_db",
+            data=encoder,
+            headers={"Content-Type": encoder.content_type},
+            timeout=120,
+        )
+        response.raise_for_status()
+        upload_result = response.json()
+    except Exception as e:
+        upload_result = {"error": f"Backend error: {e}"}
+
+    if "error" in upload_result:
+        st.sidebar.error(f"⚠️ {upload_result['error']}")
+    else:
+        session_meta["db_path"] = db_file_path
+        session_meta["upload_id"] = uploaded_file.file_id
+        st.sidebar.success("✅ Database uploaded successfully!")
+elif session_meta["db_path"]:
     st.sidebar.info(f"Using existing DB:\n{os.path.basename(db_file_path)}")
 else:
     st.sidebar.warning("⚠️ No database uploaded for this chat.")
@@ -143,11 +171,34 @@ for msg in messages:
                 except Exception as err:
                     st.error(f"Error displaying dataframe: {err}")
 
+            # larger results are browsed page by page from the backend, without asking again
+            handle = msg.metadata.get("handle")
+            num_rows = msg.metadata.get("num_rows") or 0
+            if handle and num_rows > len(msg.metadata.get("result") or []):
+                if st.toggle(f"Browse all {num_rows} rows", key=f"browse_{handle}"):
+                    pages = (num_rows + PAGE_ROWS - 1) // PAGE_ROWS
+                    page = st.number_input("Page", min_value=1, max_value=pages, value=1, key=f"page_{handle}")
+                    try:
+                        response = requests.get(
+                            f"http://localhost:8000/results/{handle}",
+                            params={"offset": (page - 1) * PAGE_ROWS, "limit": PAGE_ROWS},
+                            timeout=60,
+                        )
+                        response.raise_for_status()
+                        page_data = response.json()
+                    except Exception as e:
+                        page_data = {"error": f"Backend error: {e}"}
+
+                    if "error" in page_data:
+                        st.warning(f"⚠️ {page_data['error']}")
+                    else:
+                        st.dataframe(pd.DataFrame(page_data["rows"], columns=page_data["columns"]))
+
 # --------------------------- USER INPUT ---------------------------
 prompt = st.chat_input("Ask your question or query the database...")
 
 if prompt:
-    if not os.path.exists(db_file_path):
+    if not session_meta["db_path"]:
         st.warning("⚠️ Please upload a database before querying.")
         st.stop()
 
@@ -175,6 +226,8 @@ if prompt:
     query_text = data.get("query")
     result_data = data.get("result")
     columns = data.get("columns")
+    num_rows = data.get("num_rows")
+    handle = data.get("handle")
 
     # 4️⃣ Display AI message
     st.markdown(
@@ -200,10 +253,14 @@ if prompt:
         "query": query_text,
         "result": result_data,
         "columns": columns,
+        "num_rows": num_rows,
+        "handle": handle,
     }
 
     messages.append(ai_message)
-    history_manager.save(chat_file, messages)
+
+    # only append the new user + AI message pair, earlier messages are already stored
+    history_manager.save(chat_file, messages[-2:])
 
     # 6️⃣ Refresh view
     st.rerun()
@@ -0,0 +1,108 @@
+"""
+Offline check of speculative agent rounds with the scripted stub llm.
+
+Runs CustomAgentExecutor with two candidates against a small synthetic database and checks
+each outcome of a round: the first candidate wins, another candidate wins early (the slower
+first candidate is cancelled), another candidate saves a round the first one failed, and the
+fallback to the first candidate when no candidate succeeds. Exits non zero on a failed check.
+
+Run from the repository root:
+    python -m benchmarks.check_speculation
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from langchain_core.messages import ToolMessage
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic_db import make_database
+
+GOOD_SQL = "SELECT Name FROM artist ORDER BY ArtistId LIMIT 3"
+BAD_SQL = "SELECT Name FROM artist WHERE"
+# latency of a candidate that should not be waited for
+SLOW = 2.0
+
+
+def candidates(first: tuple[str, float], second: tuple[str, float], later: str = GOOD_SQL):
+    """
+    Stub script step: (sql, latency) for the first candidate (temperature 0) and for the second
+    in the first round, every candidate sends later in the rounds after it
+    """
+    def step(messages, temperature):
+        if any(isinstance(m, ToolMessage) for m in messages):
+            return {"name": "execute_query", "args": {"sql_query": later}, "latency": 0.01}
+        sql, latency = first if temperature == 0.0 else second
+        return {"name": "execute_query", "args": {"sql_query": sql}, "latency": latency}
+    return step
+
+
+# name -> (first candidate, second candidate, expected outcomes of the rounds, expected llm calls)
+SCENARIOS = {
+    "first candidate wins": ((GOOD_SQL, 0.05), (GOOD_SQL, SLOW), {"first": 1}, 2),
+    "second candidate wins early": ((GOOD_SQL, SLOW), (GOOD_SQL, 0.05), {"early_win": 1}, 2),
+    "second candidate saves a round": ((BAD_SQL, 0.05), (GOOD_SQL, 0.2), {"saved_round": 1}, 2),
+    "fallback to the first candidate": ((BAD_SQL, 0.05), (BAD_SQL, 0.1), {"fallback": 1, "first": 1}, 4),
+}
+OUTCOMES = ("first", "early_win", "saved_round", "fallback")
+
+
+async def run_scenario(db_path: str, first, second) -> tuple[dict, int, float, str]:
+    from agent.agent_executor import CustomAgentExecutor
+    from agent.stub_llm import StubChatModel
+    from db.context import QueryContext
+    from db.schema_cache import schema_cache
+    from memory.sqlite_history import SQLiteMessageHistory
+    from monitoring.metrics import speculation_rounds
+
+    llm = StubChatModel(script=[candidates(first, second)])
+    executor = CustomAgentExecutor(SQLiteMessageHistory("data"), llm=llm, speculative_candidates=2)
+    schema = schema_cache.get("speculation", db_path)
+    context = QueryContext("speculation", db_path, schema.db, schema.table_info, schema.index)
+
+    before = {outcome: speculation_rounds.value(outcome=outcome) for outcome in OUTCOMES}
+    start = time.perf_counter()
+    await executor.ainvoke(context, "three artists", use_history=False)
+    elapsed = time.perf_counter() - start
+    counted = {
+        outcome: int(speculation_rounds.value(outcome=outcome) - before[outcome])
+        for outcome in OUTCOMES
+        if speculation_rounds.value(outcome=outcome) != before[outcome]
+    }
+    # the last step of each candidate agent is its own copy of the stub
+    calls = sum(agent.last.calls for agent in executor.candidate_agents)
+    return counted, calls, elapsed, context.result_query
+
+
+def main():
+    # histories and caches go to a scratch directory, never into the repository's data/
+    os.chdir(tempfile.mkdtemp(prefix="nl2sql-speculation-"))
+    db_path = make_database(os.path.abspath("speculation.db"), 100)
+
+    failures = []
+    for name, (first, second, expected, expected_calls) in SCENARIOS.items():
+        counted, calls, elapsed, sql = asyncio.run(run_scenario(db_path, first, second))
+        problems = []
+        if counted != expected:
+            problems.append(f"outcomes {counted}, expected {expected}")
+        if sql != GOOD_SQL:
+            problems.append(f"adopted sql {sql!r}")
+        # the slow candidate is cancelled, not waited for
+        if elapsed >= SLOW:
+            problems.append(f"took {elapsed:.2f}s, the slow candidate was waited for")
+        if calls != expected_calls:
+            problems.append(f"{calls} llm calls, expected {expected_calls}")
+        print(f"{'ok  ' if not problems else 'FAIL'} {name}: {elapsed:.2f}s {counted}")
+        failures += [f"{name}: {problem}" for problem in problems]
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
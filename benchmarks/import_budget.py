@@ -0,0 +1,91 @@
+"""
+Check the backend's import time against a budget with `python -X importtime`.
+
+Imports each module in a fresh interpreter, so nothing is cached between them, and fails if
+its cumulative import time is over budget or if it pulls in a module that should only be
+loaded on first use (the Gemini client libraries). Prints the slowest imports of each module.
+
+Run from the repository root:
+    python -m benchmarks.import_budget
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module -> import time budget in milliseconds
+BUDGETS_MS = {
+    "setup": 200,
+    "agent.agent_executor": 2000,
+    "main": 3000,
+}
+
+# modules that must not be imported at startup, they are built lazily by setup.get_llm()
+LAZY_MODULES = ("langchain_google_genai", "google.genai", "google.api_core")
+
+
+def import_times(module: str) -> dict[str, int]:
+    """ Cumulative import time in microseconds of every module imported by importing module """
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    # main creates its data directories on import, keep them out of the repository
+    with tempfile.TemporaryDirectory(prefix="nl2sql-import-") as workdir:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=workdir, env=env, capture_output=True, text=True,
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def check(module: str, budget_ms: float, top: int) -> list[str]:
+    """ Report the import time of a module, returns the budget violations """
+    times = import_times(module)
+    total_ms = times.get(module, 0) / 1000
+    print(f"{module}: {total_ms:.0f} ms (budget {budget_ms:.0f} ms)")
+    # only top level imports, their cumulative times do not overlap
+    slowest = sorted(
+        ((name, us) for name, us in times.items() if "." not in name and name != module),
+        key=lambda item: item[1], reverse=True,
+    )
+    for name, us in slowest[:top]:
+        print(f"    {us / 1000:8.0f} ms  {name}")
+
+    problems = []
+    if total_ms > budget_ms:
+        problems.append(f"{module} took {total_ms:.0f} ms to import, budget is {budget_ms:.0f} ms")
+    for lazy in LAZY_MODULES:
+        if lazy in times:
+            problems.append(f"{module} imports {lazy} at startup")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=list(BUDGETS_MS), help="modules to check")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the budgets, e.g. on slow machines")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports shown per module")
+    args = parser.parse_args()
+
+    problems = []
+    for module in args.modules:
+        problems += check(module, BUDGETS_MS.get(module, float("inf")) * args.scale, args.top)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Offline benchmark of the agent pipeline with a scripted stub llm instead of Gemini.
+
+Drives CustomAgentExecutor directly and the FastAPI /query endpoint in process, against
+synthetic databases of increasing size and with increasing concurrency, and reports
+latency percentiles, throughput, peak RSS and the time spent per stage.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --sizes 1000 100000 --concurrency 1 16 --requests 200
+"""
+import io
+import os
+import sys
+import json
+import contextlib
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from langchain_core.messages import HumanMessage, ToolMessage
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic_db import make_database
+
+# sql that always fails and cannot be repaired locally, forces another llm round
+FAILING_SQL = "SELECT Name FROM artist WHERE"
+
+
+def benchmark_step(error_rate: float):
+    """
+    Stub llm script step: one aggregate query per question, different for every question so the
+    result cache does not hide the sql cost. error_rate of the questions first send failing sql
+    """
+    def step(messages, temperature):
+        question = next(m.content for m in reversed(messages) if isinstance(m, HumanMessage))
+        number = int(question.rsplit(" ", 1)[1])
+        failed = any(isinstance(m, ToolMessage) and "Error" in m.content for m in messages)
+        if not failed and (number % 100) < error_rate * 100:
+            return {"name": "execute_query", "args": {"sql_query": FAILING_SQL}}
+        return {"name": "execute_query", "args": {"sql_query": (
+            "SELECT a.Name, COUNT(*) AS tracks FROM track t "
+            "JOIN album al ON al.AlbumId = t.AlbumId JOIN artist a ON a.ArtistId = al.ArtistId "
+            f"WHERE t.Milliseconds > {60_000 + number} GROUP BY a.Name ORDER BY tracks DESC"
+        )}}
+    return step
+
+
+class RSSSampler:
+    """ Samples the resident set size of this process in a background thread and keeps the peak """
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            # no procfs, fall back to the lifetime peak (kilobytes on linux)
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RSSSampler":
+        self.peak = self.current()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def percentile(values: list[float], q: float) -> float:
+    """ Nearest rank percentile of a list of values """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+# question numbers are never reused, so no scenario is served from the caches of an earlier one
+_question_numbers = iter(range(10**9))
+
+async def run_load(request, num_requests: int, concurrency: int) -> tuple[list[float], float]:
+    """ Call request(n) num_requests times, concurrency at a time. Returns the latencies and the wall time """
+    limit = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(number: int):
+        async with limit:
+            start = time.perf_counter()
+            await request(number)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(next(_question_numbers)) for _ in range(num_requests)))
+    return latencies, time.perf_counter() - start
+
+
+async def bench_executor(llm, db_path: str, num_requests: int, concurrency: int, timings: list[dict]):
+    from agent.agent_executor import CustomAgentExecutor
+    from db.context import QueryContext
+    from db.schema_cache import schema_cache
+    from memory.sqlite_history import SQLiteMessageHistory
+    from memory.cached_history import CachedMessageHistory
+
+    executor = CustomAgentExecutor(CachedMessageHistory(SQLiteMessageHistory("data")), llm=llm)
+
+    async def request(i: int):
+        chat_id = f"executor-{i % concurrency}"
+        start = time.perf_counter()
+        schema = await asyncio.to_thread(schema_cache.get, chat_id, db_path)
+        context = QueryContext(chat_id, db_path, schema.db, schema.table_info, schema.index)
+        context.timings["schema"] = time.perf_counter() - start
+        await executor.ainvoke(context, f"benchmark question {i}")
+        timings.append(context.timings)
+
+    return await run_load(request, num_requests, concurrency)
+
+
+async def bench_api(llm, db_path: str, num_requests: int, concurrency: int, timings: list[dict]):
+    import httpx
+    import main
+    from agent.agent_executor_stream import StreamingAgentExecutor
+
+    class RecordingExecutor(StreamingAgentExecutor):
+        # keeps the stage timings of every request the endpoint runs
+        async def ainvoke(self, context, input, *args, **kwargs):
+            try:
+                return await super().ainvoke(context, input, *args, **kwargs)
+            finally:
+                timings.append(context.timings)
+
+    main.agent_executor = RecordingExecutor(main.message_history, llm=llm)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=300) as client:
+        # one chat per concurrent client, all uploading the same file exercises the upload dedup
+        for chat in range(concurrency):
+            with open(db_path, "rb") as f:
+                response = await client.post("/upload_db", data={"uuid": f"api-{chat}"}, files={"file": ("bench.db", f)})
+            response.raise_for_status()
+
+        async def request(i: int):
+            response = await client.post(
+                "/query", json={"uuid": f"api-{i % concurrency}", "prompt": f"benchmark question {i}"}
+            )
+            response.raise_for_status()
+
+        # /query prints every result, keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await run_load(request, num_requests, concurrency)
+
+
+def summarize(mode: str, rows: int, concurrency: int, latencies: list[float], wall: float, peak_rss: int, timings: list[dict]) -> dict:
+    stages = sorted({stage for timing in timings for stage in timing})
+    return {
+        "mode": mode,
+        "rows": rows,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / wall if wall else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": peak_rss / 1024 / 1024,
+        # mean time per request spent in each stage
+        "stages_ms": {
+            stage: sum(timing.get(stage, 0.0) for timing in timings) / max(1, len(timings)) * 1000
+            for stage in stages
+        },
+    }
+
+
+def print_report(results: list[dict]):
+    header = f"{'mode':<9}{'rows':>9}{'conc':>6}{'reqs':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'rss MB':>9}  stages (mean ms)"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        stages = ", ".join(f"{stage} {ms:.1f}" for stage, ms in r["stages_ms"].items())
+        print(
+            f"{r['mode']:<9}{r['rows']:>9}{r['concurrency']:>6}{r['requests']:>6}{r['requests_per_second']:>9.1f}"
+            f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['peak_rss_mb']:>9.1f}  {stages}"
+        )
+
+
+async def run(args) -> list[dict]:
+    from agent.stub_llm import StubChatModel
+    # imports setup.py, which loads .env and with it possibly LANGCHAIN_TRACING_V2=true
+    import agent.agent_executor
+
+    # tracing would send every stub call to langsmith
+    os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
+    results = []
+    for rows in args.sizes:
+        db_path = make_database(os.path.abspath(f"bench_{rows}.db"), rows, filler_tables=args.filler_tables)
+        for concurrency in args.concurrency:
+            for mode in args.modes:
+                llm = StubChatModel(script=[benchmark_step(args.error_rate)], latency=args.latency)
+                timings: list[dict] = []
+                bench = bench_executor if mode == "executor" else bench_api
+                with RSSSampler() as rss:
+                    latencies, wall = await bench(llm, db_path, args.requests, concurrency, timings)
+                results.append(summarize(mode, rows, concurrency, latencies, wall, rss.peak, timings))
+                print_report(results[-1:])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000], help="tracks per synthetic database")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="concurrent requests")
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("--modes", nargs="+", choices=["executor", "api"], default=["executor", "api"])
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub llm takes per call")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="share of questions whose first sql fails")
+    parser.add_argument("--filler-tables", type=int, default=20, help="unrelated tables in each database")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    # databases, history and caches go to a scratch directory, never into the repository's data/
+    output = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="nl2sql-bench-")
+    os.chdir(workdir)
+    print(f"working directory: {workdir}")
+
+    results = asyncio.run(run(args))
+    print()
+    print_report(results)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import random
+import sqlite3
+
+# rows inserted per executemany call
+INSERT_BATCH_SIZE = 10_000
+
+def make_database(path: str, num_tracks: int, filler_tables: int = 0, seed: int = 0) -> str:
+    """
+    Create a chinook like sqlite database with artist, album and track tables
+    (num_tracks tracks, 1 album per 20 tracks, 1 artist per 5 albums) and
+    filler_tables extra unrelated tables, for schema pruning to skip. Returns the path
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    num_albums = max(1, num_tracks // 20)
+    num_artists = max(1, num_albums // 5)
+
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("CREATE TABLE artist (ArtistId INTEGER PRIMARY KEY, Name TEXT NOT NULL)")
+        conn.execute(
+            "CREATE TABLE album (AlbumId INTEGER PRIMARY KEY, Title TEXT NOT NULL, "
+            "ArtistId INTEGER NOT NULL REFERENCES artist (ArtistId))"
+        )
+        conn.execute(
+            "CREATE TABLE track (TrackId INTEGER PRIMARY KEY, Name TEXT NOT NULL, "
+            "AlbumId INTEGER REFERENCES album (AlbumId), Milliseconds INTEGER NOT NULL, UnitPrice NUMERIC NOT NULL)"
+        )
+        conn.execute("CREATE INDEX track_album ON track (AlbumId)")
+        for i in range(filler_tables):
+            conn.execute(f"CREATE TABLE metric_{i} (MetricId INTEGER PRIMARY KEY, Label TEXT, Value REAL)")
+            conn.executemany(
+                f"INSERT INTO metric_{i} (Label, Value) VALUES (?, ?)",
+                [(f"label {j}", rng.random()) for j in range(10)],
+            )
+
+        conn.executemany(
+            "INSERT INTO artist (ArtistId, Name) VALUES (?, ?)",
+            [(i, f"artist {i}") for i in range(1, num_artists + 1)],
+        )
+        conn.executemany(
+            "INSERT INTO album (AlbumId, Title, ArtistId) VALUES (?, ?, ?)",
+            [(i, f"album {i}", rng.randint(1, num_artists)) for i in range(1, num_albums + 1)],
+        )
+        for start in range(1, num_tracks + 1, INSERT_BATCH_SIZE):
+            end = min(start + INSERT_BATCH_SIZE, num_tracks + 1)
+            conn.executemany(
+                "INSERT INTO track (TrackId, Name, AlbumId, Milliseconds, UnitPrice) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (i, f"track {i}", rng.randint(1, num_albums), rng.randint(60_000, 600_000), rng.choice((0.99, 1.99)))
+                    for i in range(start, end)
+                ],
+            )
+    conn.close()
+    return path
@@ -0,0 +1,71 @@
+import time
+import hashlib
+from contextlib import contextmanager
+import pandas as pd
+from langchain_community.utilities import SQLDatabase
+from db.schema_index import SchemaIndex
+from monitoring.metrics import stage_seconds
+
+class QueryContext:
+    """
+    Request scoped state for answering one question against one chat database.
+    Carries the db handle into the tools and the executed query and its results back out,
+    so concurrent requests for different chats never share state
+    """
+    def __init__(
+        self,
+        chat_id: str,
+        db_path: str,
+        db: SQLDatabase,
+        table_schema_info: str,
+        schema_index: SchemaIndex | None = None,
+    ):
+        self.chat_id = chat_id
+        self.db_path = db_path
+        self.db = db
+        self.table_schema_info = table_schema_info
+        # used to put only the tables relevant to the question into the prompt
+        self.schema_index = schema_index
+
+        # llm generated query and the top rows of its result, set by the execute_query tool
+        self.result_query: str = ""
+        self.result_df: pd.DataFrame | None = None
+        # total number of rows the query returned, result_df only holds the top rows
+        self.result_num_rows: int = 0
+        # whether the last execute_query call failed
+        self.query_failed: bool = False
+
+        # seconds spent per stage of answering (llm, tool, history, ...), summed over iterations
+        self.timings: dict[str, float] = {}
+
+    def fork(self) -> "QueryContext":
+        """
+        New context for the same database with empty results,
+        used to run candidate queries side by side without touching this context
+        """
+        return QueryContext(self.chat_id, self.db_path, self.db, self.table_schema_info, self.schema_index)
+
+    @contextmanager
+    def timed(self, stage: str):
+        """ Add the time spent in the with block to the timing of a stage and to its /metrics histogram """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+            stage_seconds.observe(elapsed, stage=stage)
+
+    def adopt(self, other: "QueryContext"):
+        """ Take over the query and results of a forked context """
+        self.result_query = other.result_query
+        self.result_df = other.result_df
+        self.result_num_rows = other.result_num_rows
+        self.query_failed = other.query_failed
+
+    @property
+    def schema_fingerprint(self) -> str:
+        """ Identifies the database schema, questions against the same schema can share cached SQL """
+        if self.schema_index is not None:
+            return self.schema_index.fingerprint
+        return hashlib.sha256(self.table_schema_info.encode()).hexdigest()
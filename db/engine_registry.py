@@ -0,0 +1,110 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+# read oriented settings applied to every new connection,
+# the databases are only ever queried so connections reject writes
+CONNECT_PRAGMAS = [
+    # map up to 256MB of the file instead of copying pages through read calls
+    "PRAGMA mmap_size = 268435456",
+    # 32MB page cache per connection, negative values are in KiB
+    "PRAGMA cache_size = -32768",
+    # sorts and temporary b-trees stay in memory
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA query_only = ON",
+]
+
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in CONNECT_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+class EngineEntry:
+    """ Pooled engine for one version of a database file """
+    def __init__(self, engine: Engine, fingerprint: tuple[str, int, int] | None):
+        self.engine = engine
+        self.fingerprint = fingerprint
+        self.last_used = time.monotonic()
+
+
+class EngineRegistry:
+    """
+    Process wide registry of pooled sqlite engines keyed by database path.
+    Questions against the same database reuse its connections and their warm page caches.
+    Engines idle for longer than idle_seconds, or beyond the max_engines most recently used,
+    are disposed, and an engine is replaced when its database file changes
+    """
+    def __init__(self, max_engines: int = 32, idle_seconds: float = 600, pool_size: int = 4, max_overflow: int = 4):
+        self.max_engines = max_engines
+        self.idle_seconds = idle_seconds
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self._entries: OrderedDict[str, EngineEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, db_path: str, fingerprint: tuple[str, int, int] | None = None) -> Engine:
+        """
+        Return the engine of a database file, creating it if needed.
+        If a fingerprint is given and differs from the one the engine was created for,
+        the engine is replaced so no connection keeps reading the old file
+        """
+        key = os.path.abspath(db_path)
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and fingerprint is not None and entry.fingerprint != fingerprint:
+                evicted.append(self._entries.pop(key))
+                entry = None
+            if entry is None:
+                entry = EngineEntry(self._create(key), fingerprint)
+                self._entries[key] = entry
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(key)
+            evicted += self._evict()
+
+        for old in evicted:
+            old.engine.dispose()
+        return entry.engine
+
+    def dispose(self, db_path: str) -> bool:
+        """
+        Close the connections to a database file and forget its engine,
+        must be called before the file is replaced. Returns True if an engine was disposed
+        """
+        with self._lock:
+            entry = self._entries.pop(os.path.abspath(db_path), None)
+        if entry is None:
+            return False
+        entry.engine.dispose()
+        return True
+
+    def _create(self, path: str) -> Engine:
+        engine = create_engine(
+            f"sqlite:///{path}",
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            # connections move between the worker threads of the query runner
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(engine, "connect", _apply_pragmas)
+        return engine
+
+    def _evict(self) -> list[EngineEntry]:
+        # caller holds the lock, the newest engine is always kept
+        evicted = []
+        now = time.monotonic()
+        while len(self._entries) > 1:
+            _, oldest = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_engines and now - oldest.last_used <= self.idle_seconds:
+                break
+            evicted.append(self._entries.popitem(last=False)[1])
+        return evicted
+
+
+# Process wide engine registry shared by the schema cache and the tools
+engine_registry = EngineRegistry()
@@ -0,0 +1,178 @@
+import io
+import csv
+from typing import Iterator
+from db.engine_registry import engine_registry
+from db.query_guard import QueryGuard
+
+# rows fetched from sqlite and written out at a time, memory stays bounded by one batch
+EXPORT_BATCH_ROWS = 10_000
+
+# exports are asked for explicitly and may read every row, so they get far larger budgets
+# than the queries of the agent loop
+EXPORT_TIMEOUT_SECONDS = 600.0
+EXPORT_MAX_VM_STEPS = 50_000_000_000
+
+# media type and file extension of each export format
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def _sqlite_kind(value) -> str:
+    # storage class of a fetched value, named like sqlite's typeof()
+    if value is None:
+        return "null"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "real"
+    if isinstance(value, bytes):
+        return "blob"
+    return "text"
+
+
+def column_kinds(conn, sql_query: str, num_columns: int) -> list[set[str]]:
+    """
+    Storage classes found in each column of a query's full result, with one extra pass over it.
+    Columns are renamed by position, so results with duplicate column names work too
+    """
+    names = [f"c{i}" for i in range(num_columns)]
+    kinds_sql = (
+        f"WITH result({', '.join(names)}) AS ({sql_query}) "
+        f"SELECT {', '.join(f'group_concat(DISTINCT typeof({name}))' for name in names)} FROM result"
+    )
+    row = conn.exec_driver_sql(kinds_sql).fetchone()
+    return [set(kinds.split(",")) if kinds else set() for kinds in row]
+
+
+def iter_batches(
+    db_path: str, sql_query: str, fingerprint: tuple[str, int, int] | None = None, with_kinds: bool = False,
+) -> Iterator[tuple[list[str], list[set[str]] | None, list[tuple]]]:
+    """
+    Run a query on a pooled read only connection and yield (columns, kinds, rows) batches of
+    EXPORT_BATCH_ROWS rows. Yields one empty batch for a query without rows, so the columns are known.
+    The connection reads the version of the file with the given fingerprint, not an older one it was opened on.
+    With with_kinds the first batch carries the storage classes of each column over the whole result,
+    taken from the rows if they all fit in the first batch and from one more pass over the result otherwise
+    """
+    with engine_registry.get(db_path, fingerprint).connect() as conn:
+        with QueryGuard(conn, timeout_seconds=EXPORT_TIMEOUT_SECONDS, max_vm_steps=EXPORT_MAX_VM_STEPS):
+            result = conn.exec_driver_sql(sql_query)
+            columns = list(result.keys())
+            rows = [tuple(row) for row in result.fetchmany(EXPORT_BATCH_ROWS)]
+            kinds = None
+            if with_kinds and len(rows) < EXPORT_BATCH_ROWS:
+                kinds = [{_sqlite_kind(row[i]) for row in rows} for i in range(len(columns))]
+            elif with_kinds:
+                kinds = column_kinds(conn, sql_query, len(columns))
+            yield columns, kinds, rows
+            while rows := [tuple(row) for row in result.fetchmany(EXPORT_BATCH_ROWS)]:
+                yield columns, None, rows
+            result.close()
+
+
+def export_csv(batches: Iterator[tuple[list[str], list[set[str]] | None, list[tuple]]]) -> Iterator[bytes]:
+    """ Encode batches as CSV with a header row """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for i, (columns, _, rows) in enumerate(batches):
+        if i == 0:
+            writer.writerow(columns)
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write only file object for the arrow writers, collects written bytes until taken.
+    Keeps counting the position after bytes are taken, which the parquet footer offsets rely on
+    """
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _arrow_type(pa, kinds: set[str]):
+    # integers stay int64, integers mixed with reals become float64,
+    # columns mixing text, blobs and numbers, and columns of only nulls, become strings
+    kinds = kinds - {"null"}
+    if kinds == {"integer"}:
+        return pa.int64()
+    if kinds and kinds <= {"integer", "real"}:
+        return pa.float64()
+    if kinds == {"blob"}:
+        return pa.binary()
+    return pa.string()
+
+
+def _record_batch(pa, schema, rows: list[tuple]):
+    arrays = []
+    for i, field in enumerate(schema):
+        values = [row[i] for row in rows]
+        if pa.types.is_string(field.type):
+            values = [None if value is None else value.hex() if isinstance(value, bytes) else str(value) for value in values]
+        try:
+            arrays.append(pa.array(values, type=field.type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError) as e:
+            # the types cover the whole result, a value only falls outside them if the data changed
+            # while exporting. Failing is better than writing it as null
+            raise ValueError(f"Column {field.name} has a value that is not {field.type}: {e}") from e
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_arrow(batches: Iterator[tuple[list[str], list[set[str]] | None, list[tuple]]], file_format: str) -> Iterator[bytes]:
+    """ Encode batches as an Arrow IPC stream or a Parquet file, one record batch / row group per batch """
+    # imported here, pyarrow is only needed by exports and slow to import
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    sink = _ChunkSink()
+    writer = None
+    for columns, kinds, rows in batches:
+        if writer is None:
+            # sqlite has no column types in a result, they come from the storage classes of the values
+            schema = pa.schema([pa.field(column, _arrow_type(pa, kinds[i])) for i, column in enumerate(columns)])
+            if file_format == "parquet":
+                writer = pyarrow.parquet.ParquetWriter(sink, schema)
+            else:
+                writer = pyarrow.ipc.new_stream(sink, schema)
+        if rows:
+            writer.write_batch(_record_batch(pa, schema, rows))
+        yield sink.take()
+
+    if writer is not None:
+        writer.close()
+        yield sink.take()
+
+
+def export_result(
+    db_path: str, sql_query: str, file_format: str, fingerprint: tuple[str, int, int] | None = None,
+) -> Iterator[bytes]:
+    """ Stream the full result of a query in one of EXPORT_FORMATS from the version of the db file with fingerprint """
+    if file_format == "csv":
+        return export_csv(iter_batches(db_path, sql_query, fingerprint))
+    # arrow and parquet need column types that fit every batch before the first one is written
+    return export_arrow(iter_batches(db_path, sql_query, fingerprint, with_kinds=True), file_format)
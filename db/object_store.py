@@ -0,0 +1,228 @@
+import os
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+
+# uploads are read and hashed in chunks of this many bytes, so memory stays flat for any file size
+CHUNK_SIZE = 1024 * 1024
+
+# os.link errors that mean the filesystem cannot hard link the object, anything else is a real error
+NO_LINK_ERRORS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+
+class DatabaseStore:
+    """
+    Content addressed store of uploaded database files.
+    Each distinct file is stored once as objects/<sha256>.db, and every chat gets its own
+    <chat id>.db path as a hard link to the object (or a copy where links are not supported).
+    The schema extracted from an object is kept next to it, and refs/<chat id>.db.json records which
+    object a chat file came from, so a known file is never reflected again by any process
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.refs_dir = os.path.join(root, "refs")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+    def object_path(self, content_hash: str) -> str:
+        return os.path.join(self.objects_dir, f"{content_hash}.db")
+
+    def schema_path(self, content_hash: str) -> str:
+        return os.path.join(self.objects_dir, f"{content_hash}.schema.json")
+
+    def ref_path(self, target_path: str) -> str:
+        return os.path.join(self.refs_dir, f"{os.path.basename(target_path)}.json")
+
+    def put(self, stream) -> tuple[str, bool]:
+        """
+        Stream a file object into the store while hashing it.
+        Returns the content hash and whether the content was new
+        """
+        content_hash, tmp_path = self._write(stream)
+        try:
+            return content_hash, self._publish(content_hash, tmp_path)
+        finally:
+            self._discard(tmp_path)
+
+    def add(self, stream, target_path: str) -> tuple[str, bool]:
+        """
+        Stream a file object into the store and point target_path at it.
+        The uploaded file is kept until the chat file is linked, an object deleted in between by a
+        concurrent upload that replaced its last chat file is put back from it.
+        Returns the content hash and whether the content was new
+        """
+        content_hash, tmp_path = self._write(stream)
+        try:
+            is_new = self._publish(content_hash, tmp_path)
+            self.link(content_hash, target_path, spare_path=tmp_path)
+        finally:
+            self._discard(tmp_path)
+        return content_hash, is_new
+
+    def _write(self, stream) -> tuple[str, str]:
+        # the temporary file is in the objects directory so linking it into place stays on one filesystem
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while chunk := stream.read(CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            self._discard(tmp_path)
+            raise
+        return digest.hexdigest(), tmp_path
+
+    def _publish(self, content_hash: str, tmp_path: str) -> bool:
+        # the upload is linked, not renamed, into place, so it can still restore the object later.
+        # While it exists the object has a second link and is never cleaned up. Returns whether it was new
+        path = self.object_path(content_hash)
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        except OSError as e:
+            if e.errno not in NO_LINK_ERRORS:
+                raise
+        # filesystems without hard links get a copy, renamed into place so readers never see half a file
+        if os.path.exists(path):
+            return False
+        fd, copy_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".part")
+        os.close(fd)
+        try:
+            shutil.copyfile(tmp_path, copy_path)
+            os.replace(copy_path, path)
+        finally:
+            self._discard(copy_path)
+        return True
+
+    @staticmethod
+    def _discard(tmp_path: str):
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def link(self, content_hash: str, target_path: str, spare_path: str | None = None):
+        """
+        Point target_path at a stored object, replacing whatever file was there atomically.
+        The object the replaced file linked to is deleted once no chat links to it anymore.
+        spare_path is a copy of the object's content that puts it back if it was deleted meanwhile
+        """
+        # a unique name, concurrent uploads to the same chat must not share the temporary file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target_path) or ".", suffix=".tmp")
+        os.close(fd)
+        os.remove(tmp_path)
+        try:
+            try:
+                self._link_object(content_hash, tmp_path, spare_path)
+            except OSError as e:
+                if e.errno not in NO_LINK_ERRORS:
+                    raise
+                # filesystems without hard links get a private copy
+                shutil.copyfile(self.object_path(content_hash), tmp_path)
+
+            # only objects the old file was linked to can be cleaned up, copies do not count as users
+            replaced = self.content_hash(target_path) if self._is_link(target_path) else None
+            if self._same_file(tmp_path, target_path):
+                # already linked to this object, renaming a link onto itself would leave both names
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, target_path)
+        except BaseException:
+            self._discard(tmp_path)
+            raise
+        self._write_ref(target_path, content_hash)
+
+        if replaced is not None and replaced != content_hash:
+            self._remove_unused(replaced)
+
+    def _link_object(self, content_hash: str, link_path: str, spare_path: str | None):
+        try:
+            os.link(self.object_path(content_hash), link_path)
+        except FileNotFoundError:
+            # a concurrent upload replaced the last chat file of the object and deleted it
+            if spare_path is None:
+                raise
+            self._publish(content_hash, spare_path)
+            os.link(self.object_path(content_hash), link_path)
+
+    def content_hash(self, target_path: str) -> str | None:
+        """
+        Hash of the object a chat file was linked or copied from,
+        None if the file does not exist or changed since it was linked
+        """
+        try:
+            with open(self.ref_path(target_path), "r") as f:
+                ref = json.load(f)
+            target = os.stat(target_path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if [target.st_dev, target.st_ino, target.st_size, target.st_mtime_ns] != ref["stat"]:
+            return None
+        return ref["hash"]
+
+    def schema_for(self, target_path: str) -> dict | None:
+        """ Schema saved for the object behind a chat file, or None if unknown """
+        content_hash = self.content_hash(target_path)
+        return self.load_schema(content_hash) if content_hash else None
+
+    def save_schema_for(self, target_path: str, schema: dict):
+        """ Save the schema extracted from a chat file for its object, if the file came from the store """
+        content_hash = self.content_hash(target_path)
+        if content_hash:
+            self.save_schema(content_hash, schema)
+
+    def _write_ref(self, target_path: str, content_hash: str):
+        # the file identity is recorded with the hash, a file replaced some other way does not match it
+        target = os.stat(target_path)
+        ref = {"hash": content_hash, "stat": [target.st_dev, target.st_ino, target.st_size, target.st_mtime_ns]}
+        fd, tmp_path = tempfile.mkstemp(dir=self.refs_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(ref, f)
+        os.replace(tmp_path, self.ref_path(target_path))
+
+    @staticmethod
+    def _same_file(path: str, other_path: str) -> bool:
+        try:
+            return os.path.samefile(path, other_path)
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _is_link(target_path: str) -> bool:
+        try:
+            return os.stat(target_path).st_nlink > 1
+        except FileNotFoundError:
+            return False
+
+    def _remove_unused(self, content_hash: str):
+        # the objects directory holds the last link, no chat file uses the object anymore
+        path = self.object_path(content_hash)
+        try:
+            if os.stat(path).st_nlink > 1:
+                return
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        if os.path.exists(self.schema_path(content_hash)):
+            os.remove(self.schema_path(content_hash))
+
+    def load_schema(self, content_hash: str) -> dict | None:
+        """ Schema saved for an object, or None if it was never extracted """
+        try:
+            with open(self.schema_path(content_hash), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save_schema(self, content_hash: str, schema: dict):
+        # written to a temporary file first so readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(schema, f)
+        os.replace(tmp_path, self.schema_path(content_hash))
@@ -0,0 +1,90 @@
+import sys
+import time
+import json
+
+# wall clock budget of one execute_query call, including counting the rows
+QUERY_TIMEOUT_SECONDS = 10.0
+
+# sqlite virtual machine instructions one execute_query call may run,
+# a few hundred million is several seconds of scanning on commodity hardware
+MAX_VM_STEPS = 200_000_000
+
+# memory the kept result rows may take
+MAX_RESULT_BYTES = 4 * 1024 * 1024
+
+# the progress handler runs every this many vm instructions, low enough to react quickly
+# and high enough to not slow queries down
+PROGRESS_INTERVAL = 10_000
+
+
+class QueryTooExpensive(Exception):
+    """ A query went over one of its budgets and was interrupted """
+    def __init__(self, reason: str, limit: float):
+        self.reason = reason
+        self.limit = limit
+        super().__init__(f"query exceeded its {reason} budget of {limit}")
+
+    def to_message(self) -> str:
+        """ Structured error for the agent scratchpad, tells the llm to rewrite the query """
+        return json.dumps({
+            "error": "query_too_expensive",
+            "budget": self.reason,
+            "limit": self.limit,
+            "hint": "rewrite the query to touch fewer rows, e.g. filter early, avoid cross joins, "
+                    "aggregate instead of listing rows or add a LIMIT",
+        })
+
+
+class QueryGuard:
+    """
+    Enforces the time, vm step and result size budgets of a query on one connection.
+    Used as a context manager around everything executed on the connection, sqlite calls the
+    progress handler while a statement runs and the statement is interrupted once a budget is used up.
+    An error raised inside the block because of that is turned into QueryTooExpensive
+    """
+    def __init__(
+        self,
+        conn,
+        timeout_seconds: float = QUERY_TIMEOUT_SECONDS,
+        max_vm_steps: int = MAX_VM_STEPS,
+        max_result_bytes: int = MAX_RESULT_BYTES,
+    ):
+        # the sqlite3 connection under the sqlalchemy one
+        self._raw = conn.connection.driver_connection
+        self.timeout_seconds = timeout_seconds
+        self.max_vm_steps = max_vm_steps
+        self.max_result_bytes = max_result_bytes
+        self.vm_steps = 0
+        # the budget that interrupted the query, if any
+        self.tripped: QueryTooExpensive | None = None
+        self._deadline = 0.0
+
+    def __enter__(self) -> "QueryGuard":
+        self._deadline = time.monotonic() + self.timeout_seconds
+        self._raw.set_progress_handler(self._progress, PROGRESS_INTERVAL)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # the connection goes back to the pool, do not leave the handler behind
+        self._raw.set_progress_handler(None, 0)
+        if exc is not None and self.tripped is not None and exc is not self.tripped:
+            raise self.tripped from exc
+        return False
+
+    def _progress(self) -> int:
+        # a non zero return value interrupts the running statement
+        self.vm_steps += PROGRESS_INTERVAL
+        if self.vm_steps > self.max_vm_steps:
+            self.tripped = QueryTooExpensive("vm_steps", self.max_vm_steps)
+            return 1
+        if time.monotonic() > self._deadline:
+            self.tripped = QueryTooExpensive("time_seconds", self.timeout_seconds)
+            return 1
+        return 0
+
+    def check_rows(self, rows: list[tuple]):
+        """ Raise QueryTooExpensive if the kept rows take more memory than allowed """
+        size = sys.getsizeof(rows) + sum(sys.getsizeof(value) for row in rows for value in row)
+        if size > self.max_result_bytes:
+            self.tripped = QueryTooExpensive("result_bytes", self.max_result_bytes)
+            raise self.tripped
@@ -0,0 +1,33 @@
+import asyncio
+import functools
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+class QueryRunner:
+    """
+    Runs blocking database work (sql execution, schema reflection) off the event loop.
+    Work goes to a bounded thread pool, and the number of concurrent calls per database
+    file is limited so one busy database cannot take over every worker
+    """
+    def __init__(self, max_workers: int = 16, per_db_limit: int = 4):
+        self.per_db_limit = per_db_limit
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sql")
+        # semaphores only live while some call for that database holds them
+        self._limits: weakref.WeakValueDictionary[str, asyncio.Semaphore] = weakref.WeakValueDictionary()
+
+    async def run(self, db_key: str, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in the thread pool, at most per_db_limit at a time for db_key
+        """
+        limit = self._limits.get(db_key)
+        if limit is None:
+            limit = asyncio.Semaphore(self.per_db_limit)
+            self._limits[db_key] = limit
+
+        async with limit:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, functools.partial(func, *args, **kwargs))
+
+
+# Process wide runner shared by all requests
+query_runner = QueryRunner()
@@ -0,0 +1,99 @@
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from db.sql_repair import QUOTED
+
+def normalize_sql(sql_query: str) -> str:
+    """
+    Collapse whitespace outside of quoted literals and identifiers and drop the trailing semicolon,
+    quoted text is kept exactly, 'a  b' and 'a b' are different values
+    """
+    parts = []
+    position = 0
+    for quoted in QUOTED.finditer(sql_query):
+        parts.append(re.sub(r"\s+", " ", sql_query[position:quoted.start()]))
+        parts.append(quoted.group())
+        position = quoted.end()
+    parts.append(re.sub(r"\s+", " ", sql_query[position:]))
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+class CachedResult:
+    """ Preview rows, columns and total row count of one query against one version of a database file """
+    def __init__(self, columns: list[str], rows: list[tuple], num_rows: int, fingerprint: tuple[str, int, int]):
+        self.columns = columns
+        self.rows = rows
+        self.num_rows = num_rows
+        self.fingerprint = fingerprint
+        # approximate memory footprint
+        self.size = sys.getsizeof(rows) + sum(sys.getsizeof(value) for row in rows for value in row)
+
+
+class ResultCache:
+    """
+    LRU cache of query results keyed on the database file and the normalized SQL text.
+    A result is only served while the database file keeps the fingerprint it had when
+    the query ran, so replacing the file invalidates every result cached for it
+    """
+    def __init__(self, max_entries: int = 512, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple[str, str], CachedResult] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, sql_query: str, fingerprint: tuple[str, int, int]) -> CachedResult | None:
+        """
+        Return the cached result of a query for the given database file fingerprint, or None
+        """
+        key = (fingerprint[0], normalize_sql(sql_query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.fingerprint != fingerprint:
+                # the file changed since this result was cached
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, sql_query: str, fingerprint: tuple[str, int, int], columns: list[str], rows: list[tuple], num_rows: int):
+        """
+        Cache the result of a query. The fingerprint must be taken before the query ran,
+        so a file replaced while the query was running is never cached under its new fingerprint
+        """
+        key = (fingerprint[0], normalize_sql(sql_query))
+        entry = CachedResult(columns, rows, num_rows, fingerprint)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._total_bytes += entry.size
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, db_path: str) -> int:
+        """
+        Drop every result cached for a database file.
+        Returns the number of results removed
+        """
+        path = os.path.abspath(db_path)
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == path]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def _remove(self, key: tuple[str, str]):
+        # caller holds the lock
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry.size
+
+
+# Process wide result cache shared by all requests
+result_cache = ResultCache()
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import sqlite3
+import secrets
+import threading
+from collections import OrderedDict
+from db.engine_registry import engine_registry
+from db.query_guard import QueryGuard
+
+# most rows a single page may return
+MAX_PAGE_ROWS = 1000
+
+
+class ResultHandle:
+    """ An executed query whose result can be paged through without the llm """
+    def __init__(self, handle: str, chat_id: str, db_path: str, sql_query: str, columns: list[str],
+                 num_rows: int, fingerprint: tuple[str, int, int] | None, expires_at: float):
+        self.handle = handle
+        self.chat_id = chat_id
+        self.db_path = db_path
+        self.sql_query = sql_query
+        self.columns = columns
+        self.num_rows = num_rows
+        # the database file version the result belongs to
+        self.fingerprint = fingerprint
+        self.expires_at = expires_at
+
+
+class ResultHandleRegistry:
+    """
+    Registry of result handles handed out with query answers.
+    A handle expires ttl_seconds after it was last used, and only the newest max_handles are kept.
+    With a path, handles are also written to a sqlite file, so any worker process of the server
+    can page through a result another one produced, and handles survive restarts
+    """
+    def __init__(self, path: str | None = None, ttl_seconds: float = 3600, max_handles: int = 10_000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_handles = max_handles
+        # ordered by expiry, using a handle moves it to the end
+        self._handles: OrderedDict[str, ResultHandle] = OrderedDict()
+        # newest handle of each chat, for exporting the last result of a chat
+        self._latest: dict[str, str] = {}
+        self._registered = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS result_handles ("
+                    "handle TEXT PRIMARY KEY, chat_id TEXT NOT NULL, db_path TEXT NOT NULL, "
+                    "sql_query TEXT NOT NULL, columns TEXT NOT NULL, num_rows INTEGER NOT NULL, "
+                    "fingerprint TEXT, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS result_handles_chat ON result_handles (chat_id, created_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS result_handles_expires ON result_handles (expires_at)")
+            self._prune()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # other worker processes write to the same file, wait for them instead of failing
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def register(self, chat_id: str, db_path: str, sql_query: str, columns: list[str],
+                 num_rows: int, fingerprint: tuple[str, int, int] | None) -> str:
+        """ Register an executed query and return its handle """
+        handle = secrets.token_urlsafe(16)
+        now = time.time()
+        entry = ResultHandle(handle, chat_id, db_path, sql_query, columns, num_rows, fingerprint, now + self.ttl_seconds)
+        with self._lock:
+            self._remember(entry, now)
+            self._latest[chat_id] = handle
+
+        if self.path:
+            conn = self._connection()
+            with conn:
+                conn.execute(
+                    "INSERT INTO result_handles (handle, chat_id, db_path, sql_query, columns, num_rows, "
+                    "fingerprint, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (handle, chat_id, db_path, sql_query, json.dumps(columns), num_rows,
+                     json.dumps(fingerprint), now, entry.expires_at),
+                )
+
+            # keep the file bounded, pruning on every register would cost more than the insert
+            with self._lock:
+                self._registered += 1
+                prune = self._registered % 256 == 0
+            if prune:
+                self._prune()
+        return handle
+
+    def get(self, handle: str) -> ResultHandle | None:
+        """ Return a handle and extend its lifetime, or None if it is unknown or expired """
+        now = time.time()
+        with self._lock:
+            entry = self._handles.get(handle)
+            if entry is not None and entry.expires_at <= now:
+                # another worker may have used it since, the file has the latest expiry
+                del self._handles[handle]
+                entry = None
+            if entry is not None:
+                entry.expires_at = now + self.ttl_seconds
+                self._handles.move_to_end(handle)
+
+        if not self.path:
+            return entry
+
+        conn = self._connection()
+        if entry is None:
+            row = conn.execute(
+                "SELECT handle, chat_id, db_path, sql_query, columns, num_rows, fingerprint FROM result_handles "
+                "WHERE handle = ? AND expires_at > ?",
+                (handle, now),
+            ).fetchone()
+            if row is None:
+                return None
+            entry = self._from_row(row, now + self.ttl_seconds)
+            with self._lock:
+                self._remember(entry, now)
+        # the extended lifetime counts for all workers
+        with conn:
+            conn.execute("UPDATE result_handles SET expires_at = ? WHERE handle = ?", (entry.expires_at, handle))
+        return entry
+
+    def latest(self, chat_id: str) -> ResultHandle | None:
+        """ Return the newest live handle of a chat, or None """
+        if self.path:
+            # the newest handle may come from another worker
+            row = self._connection().execute(
+                "SELECT handle FROM result_handles WHERE chat_id = ? AND expires_at > ? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (chat_id, time.time()),
+            ).fetchone()
+            handle = row[0] if row else None
+        else:
+            with self._lock:
+                handle = self._latest.get(chat_id)
+        return self.get(handle) if handle else None
+
+    @staticmethod
+    def _from_row(row: tuple, expires_at: float) -> ResultHandle:
+        handle, chat_id, db_path, sql_query, columns, num_rows, fingerprint = row
+        fingerprint = json.loads(fingerprint)
+        return ResultHandle(
+            handle, chat_id, db_path, sql_query, json.loads(columns), num_rows,
+            tuple(fingerprint) if fingerprint is not None else None, expires_at,
+        )
+
+    def _remember(self, entry: ResultHandle, now: float):
+        # caller holds the lock
+        self._handles[entry.handle] = entry
+        self._handles.move_to_end(entry.handle)
+        while self._handles:
+            oldest = next(iter(self._handles.values()))
+            if len(self._handles) <= self.max_handles and oldest.expires_at > now:
+                break
+            self._handles.popitem(last=False)
+            if self._latest.get(oldest.chat_id) == oldest.handle:
+                del self._latest[oldest.chat_id]
+
+    def _prune(self):
+        # delete expired handles and everything beyond the newest max_handles
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM result_handles WHERE expires_at <= ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM result_handles WHERE handle NOT IN "
+                "(SELECT handle FROM result_handles ORDER BY expires_at DESC LIMIT ?)",
+                (self.max_handles,),
+            )
+
+
+def fetch_page(entry: ResultHandle, offset: int, limit: int) -> list[tuple]:
+    """
+    Run the query of a handle again for one page of rows, on a pooled read only connection.
+    The query's own ORDER BY is kept, sqlite returns pages of an unordered query in a stable order
+    as long as the file does not change
+    """
+    limit = max(0, min(limit, MAX_PAGE_ROWS))
+    offset = max(0, offset)
+    with engine_registry.get(entry.db_path, entry.fingerprint).connect() as conn:
+        with QueryGuard(conn) as guard:
+            result = conn.exec_driver_sql(
+                f"SELECT * FROM ({entry.sql_query}\n) LIMIT ? OFFSET ?", (limit, offset)
+            )
+            rows = [tuple(row) for row in result.fetchall()]
+            guard.check_rows(rows)
+    return rows
+
@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+from langchain_community.utilities import SQLDatabase
+from db.schema_index import SchemaIndex
+from db.engine_registry import engine_registry
+from db.object_store import DatabaseStore
+from monitoring.metrics import cache_requests
+
+def file_fingerprint(db_path: str) -> tuple[str, int, int] | None:
+    """
+    Return a cheap identity for a database file (absolute path, mtime, size).
+    Returns None if the file does not exist
+    """
+    try:
+        stat = os.stat(db_path)
+    except FileNotFoundError:
+        return None
+    return (os.path.abspath(db_path), stat.st_mtime_ns, stat.st_size)
+
+
+class SchemaEntry:
+    """
+    Reflected database handle and schema text for one version of a database file
+    """
+    def __init__(self, db: SQLDatabase, index: SchemaIndex, fingerprint: tuple[str, int, int]):
+        self.db = db
+        self.index = index
+        self.table_info = index.full_table_info()
+        self.fingerprint = fingerprint
+        # approximate memory footprint, the reflected metadata grows with the schema text
+        self.size = sys.getsizeof(self.table_info) + index.size
+
+
+class SchemaCache:
+    """
+    LRU cache of reflected database schemas keyed by chat id.
+    An entry is only served while the database file still has the same fingerprint,
+    so replacing the file of a chat invalidates its entry automatically.
+    """
+    def __init__(self, max_entries: int = 64, max_bytes: int = 32 * 1024 * 1024, store: DatabaseStore | None = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # where uploaded files and their extracted schemas are kept, a miss for a file that came
+        # from the store loads its saved schema instead of reflecting the database
+        self.store = store
+        self._entries: OrderedDict[str, SchemaEntry] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, chat_id: str, db_path: str) -> SchemaEntry | None:
+        """
+        Return the cached schema for a chat, reflecting the database file on a miss.
+        Returns None if the database file does not exist
+        """
+        fingerprint = file_fingerprint(db_path)
+        if fingerprint is None:
+            self.invalidate(chat_id)
+            return None
+
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry.fingerprint == fingerprint:
+                self._entries.move_to_end(chat_id)
+            else:
+                entry = None
+        cache_requests.inc(cache="schema", outcome="hit" if entry is not None else "miss")
+
+        if entry is not None:
+            # the registry may have disposed the engine while it sat idle, the schema is still
+            # valid so wrap the new engine without reflecting all tables again
+            engine = engine_registry.get(db_path, fingerprint)
+            if entry.db._engine is not engine:
+                entry.db = SQLDatabase(engine, lazy_table_reflection=True)
+            return entry
+
+        # reflect outside the lock, this is the slow part we are caching
+        return self._load(chat_id, db_path, fingerprint)
+
+    def load(self, chat_id: str, db_path: str, index: SchemaIndex | None = None) -> SchemaEntry | None:
+        """
+        Reflect the database file of a chat and (re)fill its cache entry.
+        Used to fill the cache eagerly at upload time, an index already extracted from
+        the same file content, given or saved in the store, skips reflection. Returns None if the file does not exist
+        """
+        fingerprint = file_fingerprint(db_path)
+        if fingerprint is None:
+            self.invalidate(chat_id)
+            return None
+        return self._load(chat_id, db_path, fingerprint, index)
+
+    def invalidate(self, chat_id: str) -> bool:
+        """
+        Drop the cache entry of a chat.
+        Returns True if an entry was removed, False otherwise
+        """
+        with self._lock:
+            entry = self._entries.pop(chat_id, None)
+            if entry is None:
+                return False
+            self._total_bytes -= entry.size
+        return True
+
+    def _load(self, chat_id: str, db_path: str, fingerprint: tuple[str, int, int], index: SchemaIndex | None = None) -> SchemaEntry:
+        # pooled, tuned engine shared with every other user of this database file
+        engine = engine_registry.get(db_path, fingerprint)
+        if index is None and self.store is not None:
+            # saved when this content was first uploaded or reflected, by any process
+            known_schema = self.store.schema_for(db_path)
+            if known_schema is not None:
+                index = SchemaIndex.from_dict(known_schema)
+        if index is None:
+            db = SQLDatabase(engine)
+            index = SchemaIndex.from_database(db)
+            if self.store is not None:
+                self.store.save_schema_for(db_path, index.to_dict())
+        else:
+            db = SQLDatabase(engine, lazy_table_reflection=True)
+        entry = SchemaEntry(db, index, fingerprint)
+
+        with self._lock:
+            previous = self._entries.pop(chat_id, None)
+            if previous is not None:
+                self._total_bytes -= previous.size
+            self._entries[chat_id] = entry
+            self._total_bytes += entry.size
+
+            # evict least recently used entries, but always keep the newest one
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes
+            ):
+                _, old = self._entries.popitem(last=False)
+                self._total_bytes -= old.size
+        # engines are owned by the engine registry, dropped entries leave them for other users
+        return entry
+
+
+# Process wide schema cache shared by the api endpoints
+schema_cache = SchemaCache()
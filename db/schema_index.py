@@ -0,0 +1,165 @@
+import math
+import re
+import sys
+import json
+import hashlib
+from langchain_community.utilities import SQLDatabase
+
+# words that say nothing about which table a question is about
+STOPWORDS = {
+    "a", "all", "an", "and", "any", "are", "as", "at", "be", "by", "each", "for", "from",
+    "get", "give", "has", "have", "how", "id", "in", "is", "it", "list", "many", "me",
+    "most", "much", "of", "on", "or", "per", "return", "show", "the", "their", "them",
+    "to", "top", "total", "what", "which", "who", "with",
+}
+
+def tokenize(text: str) -> set[str]:
+    """
+    Split text or an identifier into normalized terms.
+    Handles snake_case and CamelCase identifiers and folds simple plurals, so
+    'Which artists have albums' and 'ArtistId' / 'album' produce matching terms
+    """
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    terms = set()
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.add(word)
+    return terms
+
+
+class SchemaIndex:
+    """
+    Local index of the tables of a database: their columns, foreign keys and table info text.
+    Used to put only the tables relevant to a question into the prompt of large databases
+    """
+    def __init__(self, table_infos: dict[str, str], columns: dict[str, list[str]], neighbours: dict[str, set[str]]):
+        # table info text per table, in dependency order
+        self.table_infos = table_infos
+        self.columns = columns
+        # tables linked by a foreign key in either direction
+        self.neighbours = neighbours
+
+        self._table_terms = {table: tokenize(table) for table in table_infos}
+        self._column_terms = {
+            table: set().union(*(tokenize(column) for column in columns.get(table, [])))
+            for table in table_infos
+        }
+
+        # terms that appear in few tables say more about a question than common ones
+        document_frequency: dict[str, int] = {}
+        for table in table_infos:
+            for term in self._table_terms[table] | self._column_terms[table]:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+        num_tables = len(table_infos)
+        self._idf = {term: math.log(1 + num_tables / df) for term, df in document_frequency.items()}
+
+        self.size = sum(sys.getsizeof(info) for info in table_infos.values())
+
+        # identifies the structure (tables, columns, links) but not the data of the database
+        self.fingerprint = hashlib.sha256(json.dumps(
+            [[table, columns.get(table, []), sorted(neighbours.get(table, set()))] for table in sorted(table_infos)]
+        ).encode()).hexdigest()
+
+    def to_dict(self) -> dict:
+        """ JSON serializable form of the index, restored with from_dict """
+        return {
+            "table_infos": self.table_infos,
+            "columns": self.columns,
+            "neighbours": {table: sorted(others) for table, others in self.neighbours.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SchemaIndex":
+        return cls(
+            data["table_infos"],
+            data["columns"],
+            {table: set(others) for table, others in data["neighbours"].items()},
+        )
+
+    @classmethod
+    def from_database(cls, db: SQLDatabase) -> "SchemaIndex":
+        """ Build the index from a database, reading the table info of every table once """
+        usable = set(db.get_usable_table_names())
+        table_infos = {}
+        columns = {}
+        neighbours: dict[str, set[str]] = {}
+        for table_name in db.get_usable_table_names():
+            table_infos[table_name] = db.get_table_info([table_name])
+
+        # get_table_info reflected the tables, so the metadata now has their columns and foreign keys
+        for table in db._metadata.sorted_tables:
+            if table.name not in usable:
+                continue
+            columns[table.name] = [column.name for column in table.columns]
+            for foreign_key in table.foreign_keys:
+                other = foreign_key.column.table.name
+                if other in usable and other != table.name:
+                    neighbours.setdefault(table.name, set()).add(other)
+                    neighbours.setdefault(other, set()).add(table.name)
+
+        # list tables in dependency order, like get_table_info does for the full schema
+        order = [table.name for table in db._metadata.sorted_tables if table.name in table_infos]
+        order += [table for table in table_infos if table not in order]
+        table_infos = {table: table_infos[table] for table in order if table_infos[table]}
+        return cls(table_infos, columns, neighbours)
+
+    def full_table_info(self) -> str:
+        """ Table info of every table, the same content SQLDatabase.get_table_info() returns """
+        return "\n\n".join(self.table_infos.values())
+
+    def select(self, question: str, max_tables: int = 8) -> list[str]:
+        """
+        Return the tables most relevant to a question plus their foreign key neighbours.
+        Returns an empty list if no table matches the question
+        """
+        terms = tokenize(question)
+        scores = {}
+        for table in self.table_infos:
+            score = 0.0
+            for term in terms:
+                # a match on the table name counts more than a match on a column
+                if term in self._table_terms[table]:
+                    score += 2 * self._idf[term]
+                elif term in self._column_terms[table]:
+                    score += self._idf[term]
+            if score > 0:
+                scores[table] = score
+
+        selected = sorted(scores, key=scores.get, reverse=True)[:max_tables]
+        related = set(selected)
+        for table in selected:
+            related |= self.neighbours.get(table, set())
+
+        # keep the full schema order so the pruned schema reads the same way
+        return [table for table in self.table_infos if table in related]
+
+    def table_info(self, table_names: list[str]) -> str:
+        """ Table info of the given tables only """
+        return "\n\n".join(self.table_infos[table] for table in table_names)
+
+
+def prune_schema(
+    index: SchemaIndex | None,
+    full_schema: str,
+    question: str,
+    min_tables: int = 10,
+    max_tables: int = 8,
+) -> tuple[str, bool]:
+    """
+    Pick the schema text for the prompt of a question.
+    Databases with at least min_tables tables only get the tables relevant to the question
+    plus their foreign key neighbours. Small databases, and questions that match no table,
+    get the full schema. Returns the schema text and whether it was pruned
+    """
+    if index is None or len(index.table_infos) < min_tables:
+        return full_schema, False
+
+    tables = index.select(question, max_tables)
+    if not tables or len(tables) == len(index.table_infos):
+        return full_schema, False
+    return index.table_info(tables), True
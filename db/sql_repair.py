@@ -0,0 +1,83 @@
+import re
+import difflib
+from db.schema_index import SchemaIndex
+
+# sqlite errors for identifiers that do not exist in the schema
+UNKNOWN_IDENTIFIER = re.compile(r"no such (column|table): ([\w.]+)")
+
+# string literals and quoted identifiers, never rewritten by a repair
+QUOTED = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\]")
+
+def explain_error(conn, sql_query: str) -> str | None:
+    """
+    Compile a query with EXPLAIN without running it.
+    Returns the sqlite error message, or None if the query is valid
+    """
+    try:
+        conn.exec_driver_sql(f"EXPLAIN {sql_query}").close()
+    except Exception as e:
+        return str(getattr(e, "orig", e))
+    return None
+
+def replace_identifier(sql_query: str, old: str, new: str) -> str:
+    """ Replace a bare identifier everywhere outside string literals and quoted identifiers """
+    pattern = re.compile(rf"(?<![\w.]){re.escape(old)}(?!\w)", re.IGNORECASE)
+    parts = []
+    position = 0
+    for quoted in QUOTED.finditer(sql_query):
+        parts.append(pattern.sub(new, sql_query[position:quoted.start()]))
+        parts.append(quoted.group())
+        position = quoted.end()
+    parts.append(pattern.sub(new, sql_query[position:]))
+    return "".join(parts)
+
+def closest_name(name: str, candidates: list[str]) -> str | None:
+    """ Closest candidate to a misspelt name, compared case insensitively """
+    by_lower = {candidate.lower(): candidate for candidate in candidates}
+    match = difflib.get_close_matches(name.lower(), by_lower, n=1, cutoff=0.75)
+    return by_lower[match[0]] if match else None
+
+def repair_sql(conn, sql_query: str, index: SchemaIndex | None, max_repairs: int = 5) -> tuple[str, list[tuple[str, str]]]:
+    """
+    Try to fix unknown table and column names in a query by fuzzy matching them
+    against the names in the schema index, re-validating with EXPLAIN after each fix.
+    Returns the repaired query and the (old, new) names replaced, or the original query
+    and an empty list if the query could not be repaired
+    """
+    if index is None:
+        return sql_query, []
+
+    repaired = sql_query
+    repairs = []
+    for _ in range(max_repairs):
+        error = explain_error(conn, repaired)
+        if error is None:
+            return repaired, repairs
+        match = UNKNOWN_IDENTIFIER.search(error)
+        if match is None:
+            break
+
+        kind, name = match.groups()
+        qualifier, _, identifier = name.rpartition(".")
+        if kind == "table":
+            candidates = list(index.table_infos)
+        elif qualifier in index.columns:
+            candidates = index.columns[qualifier]
+        else:
+            # prefer columns of the tables the query mentions, the qualifier may be an alias
+            mentioned = [table for table in index.columns if re.search(rf"\b{re.escape(table)}\b", repaired, re.IGNORECASE)]
+            candidates = [column for table in (mentioned or index.columns) for column in index.columns[table]]
+
+        replacement = closest_name(identifier, candidates)
+        if replacement is None or replacement.lower() == identifier.lower():
+            break
+
+        if qualifier:
+            replacement = f"{qualifier}.{replacement}"
+        repaired = replace_identifier(repaired, name, replacement)
+        repairs.append((name, replacement))
+
+    # only hand back a repaired query that is known to be valid
+    if repairs and explain_error(conn, repaired) is None:
+        return repaired, repairs
+    return sql_query, []
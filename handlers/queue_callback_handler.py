@@ -1,37 +1,41 @@
 import asyncio
 from langchain_core.callbacks import AsyncCallbackHandler
 
+# marks the end of the stream in the queue
+DONE = "<<DONE>>"
+
 class QueueCallbackHandler(AsyncCallbackHandler):
-    """ Callback handler that puts llm generated tokens into a queue"""
+    """
+    Callback handler that puts llm generated tokens and agent step events into a queue.
+    Give it a bounded queue: producers wait while the queue is full, so a slow client
+    slows the llm stream down instead of letting the queue grow without limit
+    """
 
     def __init__(self, queue: asyncio.Queue):
         self.queue = queue
-        self.final_answer_seen = False
 
     async def __aiter__(self):
+        # wait for each event instead of polling the queue
         while True:
-            if self.queue.empty():
-                await asyncio.sleep(0.1)
-                continue
-            token = self.queue.get()
-
-            if token == "<<DONE>>":
+            event = await self.queue.get()
+            if event == DONE:
                 return
-            if token:
-                yield token
+            yield event
 
-    def on_llm_new_token(self, *args, **kwargs):
-        """ Put new token into the queue. """
-        chunk = kwargs.get("chunk")
-        if chunk and getattr(chunk, "tool_calls", None):
-            tool = chunk.tool_calls[0]
-            if tool.get("name") == "final_answer":
-                self.final_answer_seen = True
-        self.queue.put_nowait(chunk)
+    async def emit(self, event: str, data: dict):
+        """ Put a step event into the queue, waiting while the queue is full """
+        await self.queue.put({"event": event, "data": data})
 
-    def on_llm_end(self, *args, **kwargs):
-        # add <<DONE>> token to the queue if final answer seen
-        if self.final_answer_seen:
-            self.queue.put_nowait("<<DONE>>")
-        else:
-            self.queue.put_nowait("<<STEP END>>")
\ No newline at end of file
+    async def done(self):
+        """ End the stream, the consumer stops after the events already queued """
+        await self.queue.put(DONE)
+
+    async def on_llm_new_token(self, token: str, *, chunk=None, **kwargs):
+        """ Put new token into the queue. """
+        # tool calls stream their arguments (e.g. the sql) in tool call chunks, not in the token text
+        message = getattr(chunk, "message", None)
+        text = token or "".join(
+            tool_chunk.get("args") or "" for tool_chunk in getattr(message, "tool_call_chunks", None) or []
+        )
+        if text:
+            await self.emit("token", {"text": text})
@@ -1,15 +1,42 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
-from langchain_community.utilities import SQLDatabase
-from handlers.queue_callback_handler import QueueCallbackHandler
+import re
+import glob
+import asyncio
+import json
+import time
+import threading
+from contextlib import asynccontextmanager
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from setup import get_llm
 from agent.agent_executor import CustomAgentExecutor
-import db.init_db as db_state
+from agent.agent_executor_stream import StreamingAgentExecutor
+from agent.batch_runner import answer_batch
+from agent.question_cache import QuestionCache
+from db.context import QueryContext
+from db.schema_cache import schema_cache
+from db.engine_registry import engine_registry
+from db.query_runner import query_runner
+from db.result_cache import result_cache
+from db.object_store import DatabaseStore, CHUNK_SIZE
+from db.schema_cache import file_fingerprint
+from db.result_handles import ResultHandleRegistry, fetch_page
+from db.export import EXPORT_FORMATS, export_result
 from pydantic import BaseModel
-from memory.message_history import JSONMessageHistory
+from memory.sqlite_history import SQLiteMessageHistory
+from memory.cached_history import CachedMessageHistory
+from monitoring.metrics import registry, request_seconds, stage_seconds
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warm up in the background, the server accepts requests right away
+    threading.Thread(target=warm_up, daemon=True).start()
+    yield
 
 # Initialize FastAPI app
-app = FastAPI(title="NL-to-SQL Agent API")
+app = FastAPI(title="NL-to-SQL Agent API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,34 +50,150 @@ app.add_middleware(
 UPLOAD_DIR = "data/uploaded_dbs"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# Initialize message history
-message_history = JSONMessageHistory('data')
+# Per chat database files live here, one <chat id>.db file per chat
+DB_DIR = "data/db"
+os.makedirs(DB_DIR, exist_ok=True)
+
+# Chat ids end up in file paths, only plain names are accepted (the frontend sends uuid4 strings)
+CHAT_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+def valid_chat_id(chat_id: str) -> bool:
+    """Whether a client supplied chat id is safe to use in a file path."""
+    return bool(CHAT_ID_PATTERN.match(chat_id))
+
+# Uploaded files are stored once per content under data/db/objects, chat files link to them
+db_store = DatabaseStore(DB_DIR)
+# every process loads the saved schema of a stored file on a cache miss instead of reflecting it
+schema_cache.store = db_store
+
+# Initialize message history, chats are kept in memory while active and written through to disk
+message_history = CachedMessageHistory(SQLiteMessageHistory('data'))
+
+# Initialize the question -> SQL cache, persisted so repeated questions skip the llm across restarts
+question_cache = QuestionCache("data/cache/questions.db")
+
+# Handles of query results for paging and export, persisted so every worker process can serve them
+result_handles = ResultHandleRegistry("data/cache/result_handles.db")
+
+# Number of server worker processes (uvicorn --workers reads the same variable).
+# All state a request needs beyond one process lives in the files under data/, so any worker
+# can serve any chat, per process caches only make repeated work cheaper
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# Opt-in speculation for interactive questions: this many llm candidates write SQL at once and the first
+# that runs successfully is used. Costs up to that many llm calls per round, 1 turns it off
+SPECULATIVE_CANDIDATES = int(os.getenv("SPECULATIVE_CANDIDATES", "1"))
+
+# Initialize the agent executor, it answers both plain and streaming queries
+agent_executor = StreamingAgentExecutor(
+    message_history, question_cache=question_cache, speculative_candidates=SPECULATIVE_CANDIDATES,
+)
+
+# Batches are limited in size and parallelism, and share one llm rate limit,
+# so a large suite of questions cannot use up the api quota of interactive users.
+# The limit is split between the worker processes, the whole server stays within it
+MAX_BATCH_PROMPTS = 500
+MAX_BATCH_PARALLELISM = 16
+BATCH_LLM_REQUESTS_PER_SECOND = float(os.getenv("BATCH_LLM_REQUESTS_PER_SECOND", "2"))
+worker_batch_requests_per_second = BATCH_LLM_REQUESTS_PER_SECOND / max(1, WORKERS)
+batch_executor = CustomAgentExecutor(
+    message_history,
+    question_cache=question_cache,
+    rate_limiter=InMemoryRateLimiter(
+        requests_per_second=worker_batch_requests_per_second,
+        max_bucket_size=max(1, worker_batch_requests_per_second),
+    ),
+)
+
+# Number of chat databases, most recently used first, whose schemas are loaded at startup. 0 turns it off
+WARM_UP_DATABASES = int(os.getenv("WARM_UP_DATABASES", "0"))
+
+def warm_up():
+    """Build the llm client and agents and load the schemas of recent chats, so the first requests after a (re)start skip it."""
+    start = time.perf_counter()
+    try:
+        get_llm()
+        # the agents are built on first access
+        agent_executor.agent
+        batch_executor.agent
+    except Exception as e:
+        # e.g. no api key, the first query reports it
+        print(f"LLM warm up failed: {e}")
 
-# Initialize the agent executor
-agent_executor = CustomAgentExecutor(message_history)
+    db_paths = sorted(glob.glob(os.path.join(DB_DIR, "*.db")), key=os.path.getmtime, reverse=True)
+    loaded = 0
+    for db_path in db_paths[:WARM_UP_DATABASES]:
+        chat_id = os.path.splitext(os.path.basename(db_path))[0]
+        try:
+            if schema_cache.get(chat_id, db_path) is not None:
+                loaded += 1
+        except Exception as e:
+            print(f"Schema warm up failed for {chat_id}: {e}")
+    print(f"Warm up done in {time.perf_counter() - start:.2f}s, {loaded} schemas loaded")
+
+# Time every request, labelled by its route (/results/{handle}) rather than the raw path,
+# so the number of label values stays bounded
+@app.middleware("http")
+async def record_request_seconds(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    request_seconds.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+    return response
 
 # Health check
 @app.get("/")
 def health():
     return {"status": "running"}
 
+# Prometheus metrics endpoint
+@app.get("/metrics")
+def metrics():
+    """Per stage latencies, request latencies, agent iterations, tool errors and cache hit rates."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 # Upload DB endpoint
 @app.post("/upload_db")
-def upload_db(file: UploadFile = File(...)):
+def upload_db(file: UploadFile = File(...), uuid: str | None = Form(None)):
 
     """Save uploaded SQLite DB and cache schema."""
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_path, "wb") as f:
-        f.write(file.file.read())
+    if uuid and not valid_chat_id(uuid):
+        return {"error": "Invalid chat id."}
+    if uuid:
+        # Database for a chat session, store it where /query looks for it
+        # and fill the schema cache eagerly so the first question does not pay for reflection
+        file_path = os.path.join(DB_DIR, f"{uuid}.db")
+        schema_cache.invalidate(uuid)
+        # close pooled connections before the file is replaced under them
+        engine_registry.dispose(file_path)
+        # the upload is streamed into the store in chunks, identical files are only kept once
+        db_store.add(file.file, file_path)
+        result_cache.invalidate(file_path)
 
-    # Build connection URI and extract schema
-    db_uri = f"sqlite:///{file_path}"
-    db_state.db_uri = db_uri
+        # a file uploaded before, by any chat, reuses the schema extracted back then,
+        # a new one is reflected and its schema saved in the store
+        try:
+            schema = schema_cache.load(uuid, file_path)
+        except Exception:
+            schema = None
+        if not schema:
+            return {"error": "Could not read the uploaded database."}
 
-    db = SQLDatabase.from_uri(db_uri)
-    db_state.db = db
+        return {
+            "message": f"Database {file.filename} uploaded successfully",
+            "db_name": file.filename,
+        }
 
-    db_state.table_schema_info = db.get_table_info()
+    # Without a chat id the file is only stored, the schema is reflected when a chat queries it
+    # only the base name of the client's file name, it must not point outside the upload directory
+    file_name = os.path.basename(file.filename or "")
+    if file_name in ("", ".", ".."):
+        file_name = "upload.db"
+    file_path = os.path.join(UPLOAD_DIR, file_name)
+    with open(file_path, "wb") as f:
+        while chunk := file.file.read(CHUNK_SIZE):
+            f.write(chunk)
 
     return {
         "message": f"Database {file.filename} uploaded successfully",
@@ -62,54 +205,183 @@ class QueryRequest(BaseModel):
     uuid: str
     prompt: str
 
+# Pydantic model for batch query endpoint
+class BatchQueryRequest(BaseModel):
+    uuid: str
+    prompts: list[str]
+    # questions answered at the same time
+    parallelism: int = 4
+
+async def load_context(chat_id: str) -> QueryContext | None:
+    """Build the request context of a chat, None if the chat has no database yet."""
+    # Look up the db of this chat on each request because request can be with different dbs
+    # different dbs might be uploaded in different chat sessions.
+    # The schema is only reflected again if the db file changed since it was cached
+    if not valid_chat_id(chat_id):
+        return None
+    db_path = os.path.join(DB_DIR, f"{chat_id}.db")
+
+    start = time.perf_counter()
+    schema = await query_runner.run(db_path, schema_cache.get, chat_id, db_path)
+    if schema is None or not schema.table_info:
+        return None
+
+    # Everything this request reads and writes lives in its own context,
+    # so concurrent requests for different chats cannot see each other's results
+    context = QueryContext(chat_id, db_path, schema.db, schema.table_info, schema.index)
+    context.timings["schema"] = time.perf_counter() - start
+    stage_seconds.observe(context.timings["schema"], stage="schema")
+    return context
+
+def register_result(context: QueryContext) -> str | None:
+    """Register a successful query result for paging through /results/{handle}."""
+    result_df = context.result_df
+    if result_df is None or context.query_failed or not len(result_df.columns):
+        return None
+    return result_handles.register(
+        context.chat_id, context.db_path, context.result_query, result_df.columns.tolist(),
+        context.result_num_rows, file_fingerprint(context.db_path),
+    )
+
 # Natural language query endpoint
 @app.post("/query")
-def run_query(req: QueryRequest):
+async def run_query(req: QueryRequest):
     """Run natural language query on uploaded DB."""
-    global agent_executor
+    context = await load_context(req.uuid)
+    if context is None:
+        return {"error": "Database schema not found. Please upload the DB first."}
 
-    # Fetch db file on each request because request can be with different dbs
-    # different dbs might be uploaded in different chat sessions
-    chat_id = req.uuid
-    db_path = f"data/db/{req.uuid}.db"
+    # llm calls are awaited and sql runs in the query runner's thread pool
+    output = await agent_executor.ainvoke(context, req.prompt)
 
-    db_uri = f"sqlite:///{db_path}"
-    db_state.db_uri = db_uri
+    if output["answer"] != "No answer found":
+        print(context.result_query)
+        print(context.result_df)
 
-    db = SQLDatabase.from_uri(db_uri)
-    db_state.db = db
+    # the handle is written to sqlite, keep that off the event loop
+    handle = await asyncio.to_thread(register_result, context)
+    return query_response(output, context, handle)
 
-    db_schema = db.get_table_info()
-    db_state.table_schema_info = db_schema
+def query_response(output: dict, context: QueryContext, handle: str | None) -> dict:
+    """Response body for an answered question."""
+    # no result if the agent never executed a query successfully
+    result_df = context.result_df
+    with context.timed("serialize"):
+        return {
+        "answer": output["answer"],
+        "query": context.result_query,
+        "result": result_df.values.tolist() if result_df is not None else [],
+        "columns": result_df.columns.tolist() if result_df is not None else [],
+        "num_rows": context.result_num_rows if result_df is not None else 0,
+        "handle": handle,
+        }
 
-    # Retrieve schema + db_uri
-    if not db_schema:
+# Streaming natural language query endpoint
+@app.post("/query/stream")
+async def run_query_stream(req: QueryRequest):
+    """Run natural language query on uploaded DB, streaming the agent steps as server sent events."""
+    context = await load_context(req.uuid)
+    if context is None:
         return {"error": "Database schema not found. Please upload the DB first."}
 
-    # Optional streaming queue if using streaming
-    # queue = asyncio.Queue()
-    # streamer = QueueCallbackHandler(queue)
+    async def events():
+        # token, sql_generated, executing, rows, query_error, final_answer and error events as they happen
+        async for event in agent_executor.astream(context, req.prompt):
+            yield f"event: {event['event']}\ndata: {json.dumps(event['data'], default=str)}\n\n"
 
-    # Run the agent (streaming)
-    # output = await agent_executor.invoke(
-    #     database_schema=table_schema,
-    #     input=req.query,
-    #     streamer=streamer
-    # )
+        # the last event carries what /query returns besides the rows, which were sent already
+        done = {
+            "query": context.result_query,
+            "num_rows": context.result_num_rows if context.result_df is not None else 0,
+            "handle": await asyncio.to_thread(register_result, context),
+        }
+        yield f"event: done\ndata: {json.dumps(done)}\n\n"
 
-    # without streaming
-    output = agent_executor.invoke(db_schema, req.prompt, chat_id)
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # ask proxies not to buffer the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    if output["answer"] != "No answer found":
-        print(db_state.result_query)
-        print(db_state.result_df)
+# Batch natural language query endpoint
+@app.post("/query/batch")
+async def run_query_batch(req: BatchQueryRequest):
+    """Answer a list of questions against the DB of one chat, streaming one JSON line per answer."""
+    if not req.prompts or len(req.prompts) > MAX_BATCH_PROMPTS:
+        return {"error": f"Send between 1 and {MAX_BATCH_PROMPTS} prompts."}
+
+    # the schema is loaded once and shared by every question of the batch
+    context = await load_context(req.uuid)
+    if context is None:
+        return {"error": "Database schema not found. Please upload the DB first."}
+
+    parallelism = max(1, min(req.parallelism, MAX_BATCH_PARALLELISM))
+
+    async def lines():
+        # answers come back in the order they finish, index says which prompt they belong to
+        async for index, question_context, output, error in answer_batch(batch_executor, context, req.prompts, parallelism):
+            if error is not None:
+                body = {"error": f"Could not answer the question: {error}"}
+            else:
+                handle = await asyncio.to_thread(register_result, question_context)
+                body = query_response(output, question_context, handle)
+            body = {"index": index, "prompt": req.prompts[index], **body}
+            yield json.dumps(body, default=str) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# Paged rows of an earlier query result
+@app.get("/results/{handle}")
+async def get_results(handle: str, offset: int = 0, limit: int = 100):
+    """Return rows offset..offset+limit of the result behind a handle."""
+    # handles of other workers are read from disk
+    entry = await asyncio.to_thread(result_handles.get, handle)
+    if entry is None:
+        return {"error": "Result not found or expired. Please ask the question again."}
+
+    # pages must come from the same version of the db file as the rest of the result
+    if file_fingerprint(entry.db_path) != entry.fingerprint:
+        return {"error": "The database changed since this result was produced. Please ask the question again."}
+
+    try:
+        rows = await query_runner.run(entry.db_path, fetch_page, entry, offset, limit)
+    except Exception as e:
+        return {"error": f"Could not fetch rows: {e}"}
 
     return {
-    "answer": output["answer"],
-    "query": db_state.result_query,
-    "result": db_state.result_df.values.tolist(),
-    "columns": db_state.result_df.columns.tolist(),
+        "handle": handle,
+        "offset": offset,
+        "num_rows": entry.num_rows,
+        "columns": entry.columns,
+        "rows": [list(row) for row in rows],
     }
 
+# Full result of the last query of a chat as a file download
+@app.get("/export/{uuid}")
+def export_last_result(uuid: str, format: str = "csv"):
+    """Stream the full result of the chat's last query as csv, arrow or parquet."""
+    if format not in EXPORT_FORMATS:
+        return {"error": f"Unknown format {format}, use one of {', '.join(EXPORT_FORMATS)}."}
+    if not valid_chat_id(uuid):
+        return {"error": "Invalid chat id."}
+
+    entry = result_handles.latest(uuid)
+    if entry is None:
+        return {"error": "No query result to export. Please ask a question first."}
+
+    # the export must be the result the user saw, not a rerun against a replaced db file
+    if file_fingerprint(entry.db_path) != entry.fingerprint:
+        return {"error": "The database changed since this result was produced. Please ask the question again."}
+
+    # the query runs again and rows are written out batch by batch as the client reads them,
+    # the full result is never held in memory
+    media_type, extension = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        export_result(entry.db_path, entry.sql_query, format, entry.fingerprint),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="result.{extension}"'},
+    )
+
 
 # Run with:  uvicorn main:app --reload
@@ -7,9 +7,10 @@ class MessageHistory(ABC):
     Any message history class implementing this abstract class must define the load and save methods
     """
     @abstractmethod
-    def load(self, path: str) -> list[BaseMessage]:
+    def load(self, path: str, limit: int | None = None) -> list[BaseMessage]:
         """
-        Takes a chat id and loads all messages corresponding to that chat id as a list of BaseMessage objects
+        Takes a chat id and loads all messages corresponding to that chat id as a list of BaseMessage objects.
+        If limit is given, only the most recent limit messages are returned
         """
         pass
 
@@ -27,4 +28,11 @@ class MessageHistory(ABC):
         Takes a chat id and deletes the memory file and db file associated with that chat.
         Returns True on success and False otherwise.
         """
-        pass
\ No newline at end of file
+        pass
+
+    def message_count(self, chat_id: str) -> int | None:
+        """
+        Takes a chat id and returns the number of messages stored for it, used by caches to notice
+        writes from other processes. Returns None if the backend cannot count cheaply
+        """
+        return None
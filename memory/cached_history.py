@@ -0,0 +1,101 @@
+import time
+import threading
+from collections import OrderedDict
+from langchain_core.messages import BaseMessage
+from memory.base_history import MessageHistory
+
+class CachedChat:
+    """ Messages of one chat held in memory, with the time it was last used """
+    def __init__(self, messages: list[BaseMessage]):
+        self.messages = messages
+        self.last_used = time.monotonic()
+
+
+class CachedMessageHistory(MessageHistory):
+    """
+    Write-through in memory cache in front of another message history backend.
+    Each chat is read from the backend once, new turns are written to the backend
+    and appended to the cached copy, and chats that stay idle are evicted.
+    Other processes (server workers, the streamlit app) may write to the same backend,
+    a cached chat whose message count no longer matches the backend is read again
+    """
+    def __init__(
+        self,
+        backend: MessageHistory,
+        max_chats: int = 256,
+        idle_seconds: float = 1800,
+        lock_stripes: int = 64,
+    ):
+        self.backend = backend
+        self.max_chats = max_chats
+        self.idle_seconds = idle_seconds
+        self._chats: OrderedDict[str, CachedChat] = OrderedDict()
+        # guards the chat map only, it is never held during backend calls
+        self._lock = threading.Lock()
+        # backend calls and changes to the messages of a chat happen under the lock of the chat,
+        # so a save can never race a cache fill of the same chat while other chats proceed.
+        # Chats share a fixed set of locks by hash, so the locks never need cleaning up
+        self._chat_locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def _chat_lock(self, chat_id: str) -> threading.Lock:
+        return self._chat_locks[hash(chat_id) % len(self._chat_locks)]
+
+    def load(self, chat_id: str, limit: int | None = None) -> list[BaseMessage]:
+        """
+        Given a chat id, return the messages of that chat, reading the backend only on a cache miss
+        or when the chat changed in the backend. Returns a copy, callers can not change the cached messages
+        """
+        with self._chat_lock(chat_id):
+            with self._lock:
+                chat = self._chats.get(chat_id)
+            if chat is not None:
+                count = self.backend.message_count(chat_id)
+                if count is not None and count != len(chat.messages):
+                    chat = None
+            if chat is None:
+                chat = CachedChat(self.backend.load(chat_id))
+
+            with self._lock:
+                chat.last_used = time.monotonic()
+                self._chats[chat_id] = chat
+                self._chats.move_to_end(chat_id)
+                self._evict()
+
+            if limit is None:
+                return list(chat.messages)
+            return chat.messages[-limit:] if limit else []
+
+    def save(self, chat_id: str, messages: list[BaseMessage]) -> bool:
+        """
+        Append the new messages to the backend and, if that succeeds, to the cached chat.
+        Returns the result of the backend save
+        """
+        with self._chat_lock(chat_id):
+            saved = self.backend.save(chat_id, messages)
+            with self._lock:
+                chat = self._chats.get(chat_id)
+                if saved and chat is not None:
+                    chat.last_used = time.monotonic()
+                    self._chats.move_to_end(chat_id)
+            if saved and chat is not None:
+                chat.messages.extend(messages)
+            return saved
+
+    def delete(self, chat_id: str) -> bool:
+        """
+        Drop the cached chat and delete it from the backend.
+        Returns the result of the backend delete
+        """
+        with self._chat_lock(chat_id):
+            with self._lock:
+                self._chats.pop(chat_id, None)
+            return self.backend.delete(chat_id)
+
+    def _evict(self):
+        # caller holds self._lock. Least recently used chats are at the front, drop them while idle or over capacity
+        cutoff = time.monotonic() - self.idle_seconds
+        while self._chats:
+            chat_id, chat = next(iter(self._chats.items()))
+            if len(self._chats) <= self.max_chats and chat.last_used >= cutoff:
+                break
+            del self._chats[chat_id]
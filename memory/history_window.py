@@ -0,0 +1,97 @@
+import re
+import threading
+from collections import OrderedDict
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+# words are split into chunks of up to 4 characters, which is close to how
+# subword tokenizers split english text, punctuation counts as one token each
+_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+# fixed cost of a message (role, separators) on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def count_tokens(text: str) -> int:
+    """ Estimate the number of llm tokens in a text locally, without calling the model """
+    return len(_TOKEN_PATTERN.findall(text))
+
+def message_tokens(message: BaseMessage) -> int:
+    """ Estimate the number of llm tokens a message adds to the prompt """
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+class HistoryWindow:
+    """
+    Selects the part of a chat history that goes into the agent prompt.
+    The most recent turns are kept whole as long as they fit in max_tokens.
+    Older turns are dropped, or folded into a short summary of the earlier questions
+    that is cached per chat and only rebuilt when more turns get folded
+    """
+    def __init__(
+        self,
+        max_tokens: int = 2000,
+        summarize: bool = True,
+        summary_tokens: int = 300,
+        max_cached_summaries: int = 256,
+    ):
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        self.summary_tokens = summary_tokens
+        self.max_cached_summaries = max_cached_summaries
+        # chat id -> (number of folded messages, summary message)
+        self._summaries: OrderedDict[str, tuple[int, SystemMessage]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def select(self, chat_id: str, messages: list[BaseMessage]) -> list[BaseMessage]:
+        """
+        Return the messages to send to the llm for this chat, bounded by the token budget
+        """
+        # walk back from the most recent message while the budget allows
+        budget = self.max_tokens - (self.summary_tokens if self.summarize else 0)
+        start = len(messages)
+        used = 0
+        while start > 0:
+            used += message_tokens(messages[start - 1])
+            if used > budget:
+                break
+            start -= 1
+
+        # never start the window in the middle of a turn
+        while start < len(messages) and not isinstance(messages[start], HumanMessage):
+            start += 1
+
+        window = messages[start:]
+        if start == 0 or not self.summarize:
+            return window
+        return [self._summary(chat_id, messages[:start])] + window
+
+    def _summary(self, chat_id: str, folded: list[BaseMessage]) -> SystemMessage:
+        with self._lock:
+            cached = self._summaries.get(chat_id)
+            if cached is not None and cached[0] == len(folded):
+                self._summaries.move_to_end(chat_id)
+                return cached[1]
+
+        # keep the most recent earlier questions that fit in the summary budget
+        lines = []
+        used = 0
+        for message in reversed(folded):
+            if not isinstance(message, HumanMessage):
+                continue
+            line = f"- {message.content}"
+            used += count_tokens(line)
+            if used > self.summary_tokens:
+                break
+            lines.append(line)
+        lines.reverse()
+
+        summary = SystemMessage(content=(
+            "Earlier in this conversation the user asked the following questions "
+            "(older turns are omitted):\n" + "\n".join(lines)
+        ))
+        with self._lock:
+            self._summaries[chat_id] = (len(folded), summary)
+            self._summaries.move_to_end(chat_id)
+            while len(self._summaries) > self.max_cached_summaries:
+                self._summaries.popitem(last=False)
+        return summary
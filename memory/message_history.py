@@ -19,7 +19,7 @@ class JSONMessageHistory(MessageHistory):
         os.makedirs(self.memory_directory, exist_ok=True)
         os.makedirs(self.db_directory, exist_ok=True)
 
-    def load(self, chat_id: str) -> list[BaseMessage | None]:
+    def load(self, chat_id: str, limit: int | None = None) -> list[BaseMessage | None]:
         """
         Given the file path for a json file,
         load the file and return the list of messages in that file
@@ -38,6 +38,8 @@ class JSONMessageHistory(MessageHistory):
             except json.JSONDecodeError:
                 history = []
 
+        if limit is not None:
+            history = history[-limit:] if limit else []
         return history
     
     def save(self, chat_id:str, messages: list[BaseMessage]) -> bool:
@@ -52,7 +54,7 @@ class JSONMessageHistory(MessageHistory):
             with open(file_path, "w") as f:
                 pass
         
-        message_history = self.load(file_name)
+        message_history = self.load(chat_id)
         message_history.extend(messages)
         messages_dict = messages_to_dict(message_history)
 
@@ -0,0 +1,114 @@
+import os
+import json
+import sqlite3
+import threading
+from langchain_core.messages import BaseMessage
+from langchain_core.messages import messages_from_dict
+from langchain_core.messages.base import message_to_dict
+from memory.base_history import MessageHistory
+
+class SQLiteMessageHistory(MessageHistory):
+    """
+    Message history stored in a single sqlite database running in WAL mode.
+    Each message is one row indexed by chat id, so saving a turn is an append
+    inside one transaction instead of rewriting the whole chat
+    """
+    def __init__(self, root_path: str):
+        """
+        Initialize the folder structure to store memory and db.
+        Take root folder path for storage from user and create /memory and /db inside,
+        the history database itself lives in /memory
+        """
+        self.data_directory = root_path
+        self.memory_directory = os.path.join(self.data_directory, "memory")
+        self.db_directory = os.path.join(self.data_directory, "db")
+
+        os.makedirs(self.data_directory, exist_ok=True)
+        os.makedirs(self.memory_directory, exist_ok=True)
+        os.makedirs(self.db_directory, exist_ok=True)
+
+        self.history_path = os.path.join(self.memory_directory, "history.db")
+
+        # sqlite connections cannot be shared between threads, keep one per thread
+        self._local = threading.local()
+
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "chat_id TEXT NOT NULL, "
+                "message TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_chat_id ON messages (chat_id, id)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # wait for other writers (other threads, the streamlit process) instead of failing
+            conn = sqlite3.connect(self.history_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, chat_id: str, limit: int | None = None) -> list[BaseMessage]:
+        """
+        Given a chat id, return the messages of that chat in order.
+        If limit is given only the most recent limit messages are read
+        """
+        conn = self._connection()
+        if limit is None:
+            rows = conn.execute(
+                "SELECT message FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT message FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+                (chat_id, limit),
+            ).fetchall()
+            rows.reverse()
+
+        return messages_from_dict([json.loads(row[0]) for row in rows])
+
+    def message_count(self, chat_id: str) -> int:
+        """
+        Given a chat id, return the number of messages of that chat, counted on the chat id index
+        """
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)
+        ).fetchone()[0]
+
+    def save(self, chat_id: str, messages: list[BaseMessage]) -> bool:
+        """
+        Given a list of new Human and AI messages, append them to the chat.
+        All messages are written in one transaction, so a turn is either fully saved or not at all.
+        If saved successfully, return True, else return False
+        """
+        rows = [(chat_id, json.dumps(message_to_dict(message))) for message in messages]
+        try:
+            conn = self._connection()
+            with conn:
+                conn.executemany("INSERT INTO messages (chat_id, message) VALUES (?, ?)", rows)
+        except sqlite3.Error:
+            return False
+        return True
+
+    def delete(self, chat_id: str) -> bool:
+        """
+        Given a chat id, delete the messages and db file associated with it.
+        Return True if deleted successfully, False if the chat or its db file does not exist
+        """
+        conn = self._connection()
+        with conn:
+            deleted = conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,)).rowcount
+
+        db_file_path = os.path.join(self.db_directory, chat_id + ".db")
+        if not deleted:
+            return False
+        if os.path.exists(db_file_path):
+            os.remove(db_file_path)
+        else:
+            return False
+
+        return True
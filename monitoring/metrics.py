@@ -0,0 +1,144 @@
+import bisect
+import threading
+
+# latency buckets in seconds, from sub millisecond cache hits to slow llm rounds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """ Monotonic counter, optionally split by a fixed set of labels """
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        """ Current value for a set of labels """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """ Histogram of observed values with fixed buckets, optionally split by a fixed set of labels """
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+                 labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = labelnames
+        # label values -> [count per bucket (last one is +Inf), sum of values]
+        self._values: dict[tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Process wide collection of metrics rendered in the Prometheus text format.
+    Recording a value only updates a few numbers under a lock, the text is only built when scraped
+    """
+    def __init__(self):
+        self._metrics: list[Counter | Histogram] = []
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+                  labelnames: tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, documentation, buckets, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Process wide registry served on /metrics
+registry = MetricsRegistry()
+
+# time spent per stage of answering a question, stages nest (the tool stage contains the sql stages)
+stage_seconds = registry.histogram(
+    "nl2sql_stage_seconds", "Time spent in each stage of answering a question.", labelnames=("stage",)
+)
+
+# time to the response headers per endpoint, streaming endpoints keep sending after that
+request_seconds = registry.histogram(
+    "nl2sql_request_seconds", "Time to respond to an http request.", labelnames=("endpoint", "method")
+)
+
+agent_iterations = registry.histogram(
+    "nl2sql_agent_iterations", "Agent loop iterations (llm calls) per question, 0 when answered from cache.",
+    buckets=(0, 1, 2, 3, 4, 5),
+)
+
+tool_errors = registry.counter(
+    "nl2sql_tool_errors_total", "Failed tool calls by kind of error.", labelnames=("tool", "kind")
+)
+
+cache_requests = registry.counter(
+    "nl2sql_cache_requests_total", "Cache lookups by cache and outcome.", labelnames=("cache", "outcome")
+)
+
+# outcome of speculative rounds: first (the first candidate won), saved_round (the first candidate failed
+# and another succeeded, a whole llm round saved), early_win (another candidate succeeded before the first
+# finished) and fallback (no candidate succeeded, the first candidate's outcome was used)
+speculation_rounds = registry.counter(
+    "nl2sql_speculation_rounds_total", "Speculative agent rounds by outcome.", labelnames=("outcome",)
+)
+
+sql_repairs = registry.counter(
+    "nl2sql_sql_repairs_total", "Queries fixed locally by repairing misspelt identifiers."
+)
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Local trace log, one json line per agent step, rotated at TRACE_MAX_BYTES with TRACE_BACKUP_COUNT old files kept
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "data/logs/traces.jsonl")
+# share of questions traced, 0 turns the local trace log off
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUP_COUNT = 5
+# server worker processes, rotating one file from several processes loses records
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+
+class _DeferredQueueHandler(QueueHandler):
+    # the default handler formats the record before queueing it, which would put the json
+    # encoding on the request path. Records are queued as they are and formatted by the listener
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, default=str)
+
+
+class Trace:
+    """
+    Steps of answering one sampled question. Recording a step only puts a dict on a queue,
+    the background listener encodes and writes it
+    """
+    def __init__(self, logger: logging.Logger, chat_id: str, question: str):
+        self._logger = logger
+        self.trace_id = uuid.uuid4().hex
+        self.chat_id = chat_id
+        self._start = time.perf_counter()
+        self.record("start", question=question)
+
+    def record(self, event: str, **data):
+        # the dict must not be changed after this, it is encoded later in the listener thread
+        self._logger.info({
+            "trace_id": self.trace_id,
+            "chat_id": self.chat_id,
+            "event": event,
+            "time": time.time(),
+            # seconds since the question came in
+            "elapsed": round(time.perf_counter() - self._start, 6),
+            **data,
+        })
+
+
+class LocalTracer:
+    """
+    Sampled trace sink writing agent steps (prompt size, tool calls, SQL, timings) to a rotating
+    log file. Writes happen in a background thread behind an in memory queue, so tracing
+    never blocks a request on disk. The thread starts with the first sampled question.
+    With several worker processes each one writes its own file, traces.<pid>.jsonl
+    """
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float,
+        max_bytes: int = TRACE_MAX_BYTES,
+        backup_count: int = TRACE_BACKUP_COUNT,
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._listener: QueueListener | None = None
+        self._logger: logging.Logger | None = None
+        self._lock = threading.Lock()
+
+    def start(self, chat_id: str, question: str) -> Trace | None:
+        """ Start tracing a question, returns None if it is not sampled """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return Trace(self._get_logger(), chat_id, question)
+
+    def _get_logger(self) -> logging.Logger:
+        with self._lock:
+            if self._logger is None:
+                path = self.path
+                if WORKERS > 1:
+                    root, extension = os.path.splitext(path)
+                    path = f"{root}.{os.getpid()}{extension}"
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                file_handler = RotatingFileHandler(path, maxBytes=self.max_bytes, backupCount=self.backup_count)
+                file_handler.setFormatter(_JsonFormatter())
+                records = queue.SimpleQueue()
+                self._listener = QueueListener(records, file_handler)
+                self._listener.start()
+
+                logger = logging.getLogger(f"nl2sql.traces.{id(self)}")
+                logger.setLevel(logging.INFO)
+                # trace records only go to the trace log, never to the application log
+                logger.propagate = False
+                logger.addHandler(_DeferredQueueHandler(records))
+                self._logger = logger
+                # write out what is still queued when the process exits
+                atexit.register(self.close)
+            return self._logger
+
+    def close(self):
+        """ Write out the queued steps and stop the background thread """
+        with self._lock:
+            if self._listener is not None:
+                self._listener.stop()
+                for handler in self._listener.handlers:
+                    handler.close()
+                for handler in list(self._logger.handlers):
+                    self._logger.removeHandler(handler)
+                self._listener = None
+                self._logger = None
+
+
+# Process wide trace sink used by the agent executors
+tracer = LocalTracer(TRACE_LOG_PATH, TRACE_SAMPLE_RATE)
@@ -1,29 +1,122 @@
 from langchain_core.tools import tool, StructuredTool
+from pydantic import BaseModel
 import pandas as pd
-import db.init_db as db_state
+from db.context import QueryContext
+from db.result_cache import result_cache
+from db.engine_registry import engine_registry
+from db.schema_cache import file_fingerprint
+from db.sql_repair import repair_sql
+from db.query_guard import QueryGuard, QueryTooExpensive
+from monitoring.metrics import cache_requests, tool_errors, sql_repairs
 
-@tool
-def execute_query(sql_query: str) -> str:
+# number of rows kept from each query result, the rest are only counted
+PREVIEW_ROWS = 10
+
+# batch size used when counting rows that are not kept
+FETCH_BATCH_SIZE = 1000
+
+def count_rows(conn, sql_query: str) -> int:
+    """
+    Count the rows returned by a query without materializing them.
+    Wraps the query in COUNT(*) so sqlite counts without building result rows,
+    and falls back to draining a cursor in batches for statements that cannot be wrapped
+    """
+    try:
+        return conn.exec_driver_sql(f"SELECT COUNT(*) FROM ({sql_query}\n)").scalar()
+    except Exception:
+        result = conn.exec_driver_sql(sql_query)
+        num_rows = 0
+        while batch := result.fetchmany(FETCH_BATCH_SIZE):
+            num_rows += len(batch)
+        return num_rows
+
+def fetch_preview(conn, sql_query: str, guard: QueryGuard | None = None) -> tuple[list[str], list[tuple], int, bool]:
+    """
+    Run a query and keep only its top PREVIEW_ROWS rows, checking their size against the guard if given.
+    Returns the columns, the preview rows, the total row count and whether the statement returns rows
+    """
+    result = conn.exec_driver_sql(sql_query)
+    returns_rows = result.returns_rows
+    if returns_rows:
+        columns = list(result.keys())
+        rows = [tuple(row) for row in result.fetchmany(PREVIEW_ROWS)]
+    else:
+        columns, rows = [], []
+    result.close()
+    if guard is not None:
+        guard.check_rows(rows)
+
+    # only count the full result if the preview is full
+    num_rows = count_rows(conn, sql_query) if len(rows) == PREVIEW_ROWS else len(rows)
+    return columns, rows, num_rows, returns_rows
+
+# Arguments the llm provides for execute_query, the request context is passed in by the executor
+class ExecuteQueryInput(BaseModel):
+    sql_query: str
+
+@tool(args_schema=ExecuteQueryInput)
+def execute_query(sql_query: str, context: QueryContext) -> str:
     """ Execute the given 'sql_query' against our database """
+    repairs = []
     try:
-        # execute the llm generated sql query against the database and store result in result dataframe
-        with db_state.db._engine.connect() as conn:
-            db_state.result_df = pd.read_sql(sql_query, conn)
+        sql_query = sql_query.strip().rstrip(";")
 
-        # store llm generated query
-        db_state.result_query = sql_query
+        # identical sql against an unchanged db file reuses the cached result
+        with context.timed("result_cache"):
+            fingerprint = file_fingerprint(context.db_path)
+            cached = result_cache.get(sql_query, fingerprint) if fingerprint else None
+        cache_requests.inc(cache="result", outcome="hit" if cached is not None else "miss")
+        if cached is not None:
+            columns, rows, num_rows = cached.columns, cached.rows, cached.num_rows
+        else:
+            # execute the llm generated sql query against the database and only fetch the top rows,
+            # number of rows returned might be too many to hold in memory
+            # connections come from the engine registry pool and are read only (query_only) from the start.
+            # The engine is looked up by the fingerprint the result is cached under, another worker may have
+            # replaced the file since the schema was loaded and old connections still read the old file
+            engine = engine_registry.get(context.db_path, fingerprint)
+            with context.timed("sql"), engine.connect() as conn:
+                # a runaway query is interrupted instead of holding a worker for minutes
+                with QueryGuard(conn) as guard:
+                    try:
+                        columns, rows, num_rows, returns_rows = fetch_preview(conn, sql_query, guard)
+                    except Exception:
+                        # misspelt table or column names are fixed locally instead of costing
+                        # another llm round trip, anything else goes back to the llm
+                        if guard.tripped is not None:
+                            raise
+                        sql_query, repairs = repair_sql(conn, sql_query, context.schema_index)
+                        if not repairs:
+                            raise
+                        sql_repairs.inc(len(repairs))
+                        columns, rows, num_rows, returns_rows = fetch_preview(conn, sql_query, guard)
 
-        # Now the summary text to be returned by the tool
-        num_rows = len(db_state.result_df)
+            # statements that do not return rows are not worth caching
+            if fingerprint and returns_rows:
+                result_cache.put(sql_query, fingerprint, columns, rows, num_rows)
 
-        # number of rows returned might be too many so only display the top 10 rows
-        db_state.result_df = db_state.result_df.head(10)
+        # store llm generated query and the top rows in the result dataframe
+        with context.timed("dataframe"):
+            context.result_df = pd.DataFrame.from_records(rows, columns=columns)
+        context.result_query = sql_query
+        context.result_num_rows = num_rows
+        context.query_failed = False
 
         # message string to pass to the agent scratchpad in case of successful result
         msg = f"Successfully executed query, returned {num_rows} rows"
+        if repairs:
+            fixed = ", ".join(f"{old} -> {new}" for old, new in repairs)
+            msg += f" (auto-repaired identifiers: {fixed}, executed query: {sql_query})"
         return msg
+    except QueryTooExpensive as e:
+        # structured so the llm knows to rewrite the query rather than retry it
+        context.query_failed = True
+        tool_errors.inc(tool="execute_query", kind="too_expensive")
+        return f"Error executing query: {e.to_message()}"
     except Exception as e:
         # message string to pass to the agent scratchpad in case of error or failed result
+        context.query_failed = True
+        tool_errors.inc(tool="execute_query", kind="sql_error")
         return f"Error executing query: {str(e)}"
 
 @tool
@@ -50,4 +143,13 @@ def final_answer(answer: str, tools_used: list[str]) -> dict[str|list[str | None
 tools: list[StructuredTool] = [execute_query, final_answer]
 
 # Map tool names to tool function to execute later
-tool_func_map = {tool.name : tool.func  for tool in tools}
\ No newline at end of file
+tool_func_map = {tool.name : tool.func  for tool in tools}
+
+# Tools that need the request context to run
+context_tools = {execute_query.name}
+
+def run_tool(tool_name: str, tool_args: dict, context: QueryContext):
+    """ Execute a tool by name, passing the request context to the tools that need it """
+    if tool_name in context_tools:
+        return tool_func_map[tool_name](**tool_args, context=context)
+    return tool_func_map[tool_name](**tool_args)
\ No newline at end of file